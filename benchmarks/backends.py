@@ -0,0 +1,77 @@
+"""
+Compare the thread and process backends of the CLI (-bk) on a few workloads.
+
+Usage: python benchmarks/backends.py [-c COUNT] [-t WORKERS [WORKERS ...]]
+
+Threads skip the pool start-up, the argument pickling and the per-process
+copies of fonts and images. On several cores, they should scale where the
+time is spent in Pillow and OpenCV, which release the GIL (resizing,
+filtering, remapping, encoding), and processes where the time is spent in
+Python code, like the per-column loops of the non fused distortion or the
+text layout. Run it on the target machine to find out.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from trdg.data_generator import FakeTextDataGenerator
+
+FONT = os.path.join(os.path.dirname(__file__), "..", "tests", "font.ttf")
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), "..", "trdg", "images")
+TEXT = "The quick brown fox jumps"
+
+CASES = [
+    # (name, size, background, distorsion, blur, fused geometry)
+    ("plain 32px", 32, 1, 0, 0, False),
+    ("noise+blur 64px", 64, 0, 0, 2, False),
+    ("image 64px", 64, 4, 0, 1, False),
+    ("random distortion", 48, 1, 3, 0, False),
+    ("random distortion -fg", 48, 1, 3, 0, True),
+]
+
+
+def run(backend, workers, count, out_dir, size, background, distorsion, blur, fused):
+    args = [
+        (
+            i, TEXT, FONT, out_dir, size, "jpg", 3, True, blur, False, background,
+            distorsion, 0, False, 2, -1, 0, "#282828", 0, 1.0, 0, (5, 5, 5, 5),
+            False, False, False, IMAGE_DIR, 0, "#282828", "RGB", 0, 1.0, fused,
+        )
+        for i in range(count)
+    ]
+    start = time.perf_counter()
+    pool = (ThreadPool if backend == "threads" else Pool)(workers)
+    for _ in pool.imap_unordered(FakeTextDataGenerator.generate_from_tuple, args):
+        pass
+    pool.terminate()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-c", "--count", type=int, default=200)
+    parser.add_argument("-t", "--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    print("{:<24} {:>8} {:>14} {:>14} {:>8}".format(
+        "case", "workers", "threads (/s)", "processes (/s)", "ratio"
+    ))
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, *params in CASES:
+            for workers in args.workers:
+                threads = run("threads", workers, args.count, out_dir, *params)
+                processes = run("processes", workers, args.count, out_dir, *params)
+                print("{:<24} {:>8} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                    name, workers, threads, processes, threads / processes
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare the rotate -> distort -> resize chain with the fused geometry remap.
+
+Usage: python benchmarks/fused_geometry.py [-n ITERATIONS] [-f FORMAT]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from PIL import Image
+
+from trdg import computer_text_generator, distorsion_generator, geometry_generator
+
+FONT = os.path.join(os.path.dirname(__file__), "..", "tests", "font.ttf")
+
+# The random distortion draws new offsets on every call, its MAD is only
+# indicative of the amplitude of the distortion
+CASES = [
+    # (name, skewing angle, distorsion type, vertical, horizontal)
+    ("none", 0, 0, False, False),
+    ("skew", 5, 0, False, False),
+    ("sine", 0, 1, True, False),
+    ("skew+sine", 5, 1, True, False),
+    ("skew+cosine both", 5, 2, True, True),
+    ("skew+random both", 5, 3, True, True),
+]
+
+
+def chain(image, mask, angle, distorsion_type, vertical, horizontal, height):
+    rotated_img = image.rotate(angle, expand=1)
+    rotated_mask = mask.rotate(angle, expand=1)
+
+    if distorsion_type == 0:
+        distorted_img, distorted_mask = rotated_img, rotated_mask
+    else:
+        distorted_img, distorted_mask = {
+            1: distorsion_generator.sin,
+            2: distorsion_generator.cos,
+            3: distorsion_generator.random,
+        }[distorsion_type](
+            rotated_img, rotated_mask, vertical=vertical, horizontal=horizontal
+        )
+
+    new_width = int(distorted_img.size[0] * (height / distorted_img.size[1]))
+    return (
+        distorted_img.resize((new_width, height), Image.Resampling.LANCZOS),
+        distorted_mask.resize((new_width, height), Image.Resampling.NEAREST),
+    )
+
+
+def fused(image, mask, angle, distorsion_type, vertical, horizontal, height):
+    return geometry_generator.fused_transform(
+        image,
+        mask,
+        angle,
+        distorsion_type,
+        vertical,
+        horizontal,
+        lambda w, h: (int(w * (height / h)), height),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("-f", "--format", type=int, default=32)
+    args = parser.parse_args()
+
+    image, mask, _ = computer_text_generator.generate(
+        "The quick brown fox jumps", FONT, "#282828", args.format, 0, 1, 0, False, False
+    )
+    height = args.format - 10
+
+    print("{:<20} {:>12} {:>12} {:>8} {:>10}".format(
+        "case", "chain (ms)", "fused (ms)", "speedup", "alpha MAD"
+    ))
+    for name, angle, distorsion_type, vertical, horizontal in CASES:
+        params = (image, mask, angle, distorsion_type, vertical, horizontal, height)
+        chain_time = timeit.timeit(lambda: chain(*params), number=args.iterations)
+        fused_time = timeit.timeit(lambda: fused(*params), number=args.iterations)
+
+        chain_img, _ = chain(*params)
+        fused_img, _ = fused(*params)
+        mad = np.abs(
+            np.asarray(chain_img, dtype=np.float64)[..., 3]
+            - np.asarray(fused_img, dtype=np.float64)[..., 3]
+        ).mean()
+
+        print("{:<20} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10.2f}".format(
+            name,
+            1000 * chain_time / args.iterations,
+            1000 * fused_time / args.iterations,
+            chain_time / fused_time,
+            mad,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Measure the generation speed (images/s) and peak memory over a matrix of cases.
+
+Usage: python benchmarks/suite.py [-n COUNT] [-r REPEAT] [-o RESULTS] [-b BASELINE]
+                                  [-st SPEED_THRESHOLD] [-mt MEMORY_THRESHOLD]
+                                  [-k FILTER]
+
+Every case changes one parameter of a base case (plain white background, no
+distortion, horizontal latin text of 3 words, no bounding boxes) and runs in
+its own process, so that its peak RSS is not inherited from the previous
+ones. The speed is the best of REPEAT passes over COUNT samples. The results
+are written as JSON with -o. With -b, they are compared to a previous
+results file, such as benchmarks/baseline.json: a case regresses when its speed drops by more than the speed
+threshold, or when its peak RSS grows by more than the memory threshold
+(both relative, 10% and 20% by default). The exit code is 1 if any case
+regressed.
+
+Cases whose font or dictionary is not bundled are reported as skipped.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# language: (fonts directory, dictionary or words). No Hindi dictionary
+# ships, so a few words are used instead. Chinese is not covered, no font
+# with its glyphs ships (-l cn needs fonts/cn), Korean stands in for CJK.
+LANGUAGES = {
+    "latin": ("latin", "fr"),
+    "ar": ("ar", "ar"),
+    "hi": (
+        "hi",
+        ["परीक्षा", "भाषा", "पुस्तक", "विद्यालय", "समाचार", "दुनिया", "नमस्ते"],
+    ),
+    "ko": ("ko", "ko"),
+    "th": ("th", "th"),
+}
+
+BASE = {
+    "background": 1,
+    "distorsion": 0,
+    "orientation": 0,
+    "word_split": False,
+    "language": "latin",
+    "length": 3,
+    "output_bboxes": 0,
+}
+
+MATRIX = {
+    "background": [0, 1, 2, 3, 4],
+    "distorsion": [0, 1, 2, 3],
+    "orientation": [0, 1, 2],
+    "word_split": [False, True],
+    "language": list(LANGUAGES),
+    "length": [1, 3, 10],
+    "output_bboxes": [0, 1, 2, 3],
+}
+
+
+def cases():
+    """
+    The base case, then one case per value of every parameter
+    """
+
+    yield "base", BASE
+    for parameter, values in MATRIX.items():
+        for value in values:
+            if value != BASE[parameter]:
+                yield "{}={}".format(parameter, value), dict(BASE, **{parameter: value})
+
+
+def run_case(case, count, repeat, out_dir):
+    from trdg.data_generator import FakeTextDataGenerator
+    from trdg.string_generator import create_strings_from_dict
+    from trdg.utils import load_dict
+
+    font_dir, words = LANGUAGES[case["language"]]
+    font_dir = os.path.join(ROOT, "trdg", "fonts", font_dir)
+    if not os.path.isdir(font_dir):
+        return {"skipped": "no fonts in trdg/fonts/" + case["language"]}
+    if isinstance(words, str):
+        dict_path = os.path.join(ROOT, "trdg", "dicts", words + ".txt")
+        if not os.path.isfile(dict_path):
+            return {"skipped": "no trdg/dicts/{}.txt".format(words)}
+        words = load_dict(dict_path)
+
+    fonts = sorted(
+        os.path.join(font_dir, f) for f in os.listdir(font_dir) if f.endswith(".ttf")
+    )
+    strings = create_strings_from_dict(case["length"], False, count, words)
+    if case["language"] == "ar":
+        from arabic_reshaper import ArabicReshaper
+        from bidi.algorithm import get_display
+
+        arabic_reshaper = ArabicReshaper()
+        strings = [
+            " ".join(
+                [get_display(arabic_reshaper.reshape(w)) for w in s.split(" ")[::-1]]
+            )
+            for s in strings
+        ]
+
+    def generate(i):
+        FakeTextDataGenerator.generate(
+            i,
+            strings[i % len(strings)],
+            fonts[i % len(fonts)],
+            out_dir,
+            32,
+            "jpg",
+            0,
+            False,
+            0,
+            False,
+            case["background"],
+            case["distorsion"],
+            0,
+            False,
+            2,
+            -1,
+            0,
+            "#282828",
+            case["orientation"],
+            1.0,
+            0,
+            (5, 5, 5, 5),
+            False,
+            False,
+            case["word_split"],
+            os.path.join(ROOT, "trdg", "images"),
+            output_bboxes=case["output_bboxes"],
+        )
+
+    # Load the fonts and the images once before timing
+    generate(0)
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(count):
+            generate(i)
+        elapsed.append(time.perf_counter() - start)
+
+    return {
+        "images_per_second": count / min(elapsed),
+        # Kilobytes on Linux, bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 ** 2 if sys.platform == "darwin" else 1024),
+    }
+
+
+def compare(results, baseline, speed_threshold, memory_threshold):
+    """
+    Print the change of every case from the baseline and return the names of
+    the cases that regressed
+    """
+
+    regressions = []
+    print()
+    print("{:<24} {:>12} {:>12}  {}".format("case", "speed", "peak RSS", ""))
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if "skipped" in result or previous is None or "skipped" in previous:
+            continue
+        speed = result["images_per_second"] / previous["images_per_second"] - 1
+        memory = result["peak_rss_mb"] / previous["peak_rss_mb"] - 1
+        regressed = speed < -speed_threshold or memory > memory_threshold
+        if regressed:
+            regressions.append(name)
+        print("{:<24} {:>+11.1%} {:>+11.1%}  {}".format(
+            name, speed, memory, "REGRESSION" if regressed else ""
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--count", type=int, default=50)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", type=str, help="Write the results here")
+    parser.add_argument("-b", "--baseline", type=str, help="Results to compare with")
+    parser.add_argument("-st", "--speed-threshold", type=float, default=0.1)
+    parser.add_argument("-mt", "--memory-threshold", type=float, default=0.2)
+    parser.add_argument(
+        "-k", "--filter", type=str, default="", help="Only run the cases containing it"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    print("{:<24} {:>12} {:>14}".format("case", "images/s", "peak RSS (MB)"))
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, case in cases():
+            if args.filter not in name:
+                continue
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                results[name] = executor.submit(
+                    run_case, case, args.count, args.repeat, out_dir
+                ).result()
+            if "skipped" in results[name]:
+                print("{:<24} skipped: {}".format(name, results[name]["skipped"]))
+            else:
+                print("{:<24} {:>12.1f} {:>14.1f}".format(
+                    name,
+                    results[name]["images_per_second"],
+                    results[name]["peak_rss_mb"],
+                ))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "count": args.count,
+                    "repeat": args.repeat,
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "cpu_count": os.cpu_count(),
+                    "cases": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["cases"]
+        regressions = compare(
+            results, baseline, args.speed_threshold, args.memory_threshold
+        )
+        if regressions:
+            print(
+                "\n{} regression(s): {}".format(len(regressions), ", ".join(regressions))
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
+import asyncio
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 import subprocess
 import hashlib
+import json
 import string
+import threading
+import time
+import tracemalloc
+from multiprocessing.pool import ThreadPool
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "./trdg")))
 
@@ -12,10 +20,19 @@ try:
 except:
     pass
 
+import numpy as np
 from diffimg import diff
+from PIL import Image, ImageFont
 
 from trdg.data_generator import FakeTextDataGenerator
-from trdg import background_generator
+from trdg import metrics, profiling, run
+from trdg import server as sample_server
+from trdg import (
+    background_generator,
+    computer_text_generator,
+    distorsion_generator,
+    geometry_generator,
+)
 from trdg.generators import (
     GeneratorFromDict,
     GeneratorFromRandom,
@@ -88,6 +105,55 @@ class Generators(unittest.TestCase):
         next(generator)
         self.assertRaises(StopIteration, generator.next)
 
+    def test_generator_from_strings_with_workers(self):
+        strings = ["TEST {}".format(i) for i in range(5)]
+        generator = GeneratorFromStrings(
+            strings, count=12, fonts=["tests/font.ttf"], num_workers=2, prefetch=3
+        )
+        labels = [lbl for (img, meta_data), lbl in generator]
+        self.assertEqual(labels, (strings * 3)[:12])
+        self.assertIsNone(generator.pool)
+
+    def test_generator_from_strings_with_shared_memory(self):
+        generator = GeneratorFromStrings(
+            ["TEST TEST"],
+            count=6,
+            fonts=["tests/font.ttf"],
+            num_workers=2,
+            prefetch=2,
+            shared_memory_slots=3,
+        )
+        for (img, meta_data), lbl in generator:
+            self.assertEqual(img.dtype, np.uint8)
+            self.assertEqual(img.shape[0], 32)
+            generator.release(meta_data["slot"])
+
+    def test_generator_from_strings_async(self):
+        strings = ["TEST {}".format(i) for i in range(5)]
+        generator = GeneratorFromStrings(strings, count=7, fonts=["tests/font.ttf"])
+
+        async def collect():
+            return [lbl async for (img, meta_data), lbl in generator]
+
+        self.assertEqual(asyncio.run(collect()), (strings * 2)[:7])
+
+    def test_generator_from_strings_bucketed_batches(self):
+        strings = ["TEST " * (i % 7 + 1) for i in range(50)]
+        generator = GeneratorFromStrings(
+            strings,
+            count=50,
+            fonts=["tests/font.ttf"],
+            bucket_batch_size=8,
+            bucket_padding=0.1,
+        )
+        count = 0
+        for images, widths, labels in generator:
+            self.assertEqual(len(labels), images.shape[0])
+            self.assertEqual(len(set(labels)), 1)
+            self.assertLess((images.shape[2] - widths).mean(), 0.1 * images.shape[2])
+            count += len(labels)
+        self.assertEqual(count, 50)
+
 
 class DataGenerator(unittest.TestCase):
     def test_create_string_from_wikipedia(self):
@@ -148,6 +214,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_0.jpg")
 
         self.assertLess(
             diff(
@@ -158,8 +225,6 @@ class DataGenerator(unittest.TestCase):
             0.11
         )
 
-        os.remove("tests/out/TEST TEST TEST_0.jpg")
-
     def test_generate_data_with_extension(self):
         FakeTextDataGenerator.generate(
             1,
@@ -189,6 +254,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_1.png")
 
         self.assertLess(
             diff(
@@ -199,8 +265,6 @@ class DataGenerator(unittest.TestCase):
             0.07
         )
 
-        os.remove("tests/out/TEST TEST TEST_1.png")
-
     def test_generate_data_with_skew_angle(self):
         FakeTextDataGenerator.generate(
             2,
@@ -230,6 +294,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_2.jpg")
 
         self.assertLess(
             diff(
@@ -240,8 +305,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_2.jpg")
-
     def test_generate_data_with_blur(self):
         FakeTextDataGenerator.generate(
             3,
@@ -271,6 +334,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_3.jpg")
 
         self.assertLess(
             diff(
@@ -281,8 +345,6 @@ class DataGenerator(unittest.TestCase):
             0.06
         )
 
-        os.remove("tests/out/TEST TEST TEST_3.jpg")
-
     def test_generate_data_with_sine_distorsion(self):
         FakeTextDataGenerator.generate(
             4,
@@ -312,6 +374,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_4.jpg")
 
         self.assertLess(
             diff(
@@ -322,8 +385,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_4.jpg")
-
     def test_generate_data_with_cosine_distorsion(self):
         FakeTextDataGenerator.generate(
             5,
@@ -353,6 +414,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_5.jpg")
 
         self.assertLess(
             diff(
@@ -363,8 +425,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_5.jpg")
-
     def test_generate_data_with_left_alignment(self):
         FakeTextDataGenerator.generate(
             6,
@@ -394,6 +454,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_6.jpg")
 
         self.assertLess(
             diff(
@@ -404,8 +465,6 @@ class DataGenerator(unittest.TestCase):
             0.07
         )
 
-        os.remove("tests/out/TEST TEST TEST_6.jpg")
-
     def test_generate_data_with_center_alignment(self):
         FakeTextDataGenerator.generate(
             7,
@@ -435,6 +494,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_7.jpg")
 
         self.assertLess(
             diff(
@@ -445,8 +505,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_7.jpg")
-
     def test_generate_data_with_right_alignment(self):
         FakeTextDataGenerator.generate(
             8,
@@ -476,6 +534,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_8.jpg")
 
         self.assertLess(
             diff(
@@ -486,8 +545,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_8.jpg")
-
     def test_raise_if_handwritten_and_vertical(self):
         try:
             FakeTextDataGenerator.generate(
@@ -551,6 +608,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_10.jpg")
 
         self.assertLess(
             diff(
@@ -561,8 +619,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_10.jpg")
-
     def test_generate_horizontal_text_with_variable_space(self):
         FakeTextDataGenerator.generate(
             11,
@@ -592,6 +648,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_11.jpg")
 
         self.assertLess(
             diff(
@@ -602,8 +659,6 @@ class DataGenerator(unittest.TestCase):
             0.09
         )
 
-        os.remove("tests/out/TEST TEST TEST_11.jpg")
-
     def test_generate_vertical_text_with_variable_space(self):
         FakeTextDataGenerator.generate(
             12,
@@ -633,6 +688,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_12.jpg")
 
         self.assertLess(
             diff(
@@ -643,8 +699,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_12.jpg")
-
     def test_generate_text_with_unknown_orientation(self):
         try:
             FakeTextDataGenerator.generate(
@@ -708,6 +762,7 @@ class DataGenerator(unittest.TestCase):
             False,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_13.jpg")
 
         self.assertLess(
             diff(
@@ -718,8 +773,6 @@ class DataGenerator(unittest.TestCase):
             0.19
         )
 
-        os.remove("tests/out/TEST TEST TEST_13.jpg")
-
     def test_generate_data_with_word_split(self):
         FakeTextDataGenerator.generate(
             14,
@@ -749,6 +802,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_14.png")
 
         self.assertLess(
             diff(
@@ -759,8 +813,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_14.png")
-
     def test_generate_data_with_first_name_format(self):
         FakeTextDataGenerator.generate(
             15,
@@ -790,6 +842,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_15.png")
 
         self.assertLess(
             diff(
@@ -800,8 +853,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_15.png")
-
     def test_generate_data_with_second_name_format(self):
         FakeTextDataGenerator.generate(
             16,
@@ -831,6 +882,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/16_TEST TEST TEST.png")
 
         self.assertLess(
             diff(
@@ -841,8 +893,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/16_TEST TEST TEST.png")
-
     def test_generate_data_with_third_name_format(self):
         FakeTextDataGenerator.generate(
             17,
@@ -872,6 +922,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/17.png")
 
         self.assertLess(
             diff(
@@ -882,8 +933,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/17.png")
-
     def test_generate_data_with_wrong_name_format(self):
         FakeTextDataGenerator.generate(
             18,
@@ -913,6 +962,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_18.png")
 
         self.assertLess(
             diff(
@@ -923,8 +973,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/TEST TEST TEST_18.png")
-
     def test_generate_data_with_quasicrystal_background_from_generate(self):
         FakeTextDataGenerator.generate(
             19,
@@ -954,8 +1002,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
-
-        os.remove("tests/out/TEST TEST TEST_19.png")
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_19.png")
 
     def test_raise_if_invalid_orientation(self):
         try:
@@ -1020,6 +1067,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/21_اختبار اختبار اختبار.png")
 
         self.assertLess(
             diff(
@@ -1030,8 +1078,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/21_اختبار اختبار اختبار.png")
-
     def test_generate_data_with_sorani_kurdish_text(self):
         FakeTextDataGenerator.generate(
             23,
@@ -1061,6 +1107,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/23_تاقیکردنەوە تاقیکردنەوە تاقیکردنەوە.png")
 
         self.assertLess(
             diff(
@@ -1071,8 +1118,6 @@ class DataGenerator(unittest.TestCase):
             0.05
         )
 
-        os.remove("tests/out/23_تاقیکردنەوە تاقیکردنەوە تاقیکردنەوە.png")
-
     def test_generate_data_with_hindi_text(self):
         FakeTextDataGenerator.generate(
             22,
@@ -1102,6 +1147,7 @@ class DataGenerator(unittest.TestCase):
             True,
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
         )
+        self.addCleanup(os.remove, "tests/out/22_परकष परकष परकष.png")
 
         self.assertLess(
             diff(
@@ -1112,8 +1158,6 @@ class DataGenerator(unittest.TestCase):
             0.17
         )
 
-        os.remove("tests/out/22_परकष परकष परकष.png")
-
     def test_generate_data_with_output_bounding_box(self):
         FakeTextDataGenerator.generate(
             21,
@@ -1144,6 +1188,8 @@ class DataGenerator(unittest.TestCase):
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
             output_bboxes=1,
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_21.jpg")
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_21_boxes.txt")
 
         self.assertLess(
             diff(
@@ -1154,9 +1200,6 @@ class DataGenerator(unittest.TestCase):
             0.11
         )
 
-        os.remove("tests/out/TEST TEST TEST_21.jpg")
-        os.remove("tests/out/TEST TEST TEST_21_boxes.txt")
-
     def test_generate_data_with_tesseract_output_bounding_box(self):
         FakeTextDataGenerator.generate(
             22,
@@ -1187,6 +1230,8 @@ class DataGenerator(unittest.TestCase):
             os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
             output_bboxes=2,
         )
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_22.jpg")
+        self.addCleanup(os.remove, "tests/out/TEST TEST TEST_22.box")
 
         self.assertLess(
             diff(
@@ -1197,9 +1242,6 @@ class DataGenerator(unittest.TestCase):
             0.11
         )
 
-        os.remove("tests/out/TEST TEST TEST_22.jpg")
-        os.remove("tests/out/TEST TEST TEST_22.box")
-
     def test_generate_string_with_letters(self):
         s = create_strings_randomly(1, False, 1, True, False, False, "en")[0]
 
@@ -1233,6 +1275,7 @@ class DataGenerator(unittest.TestCase):
         background_generator.plain_white(64, 128).convert("RGB").save(
             "tests/out/white_background.jpg"
         )
+        self.addCleanup(os.remove, "tests/out/white_background.jpg")
 
         self.assertTrue(
             diff(
@@ -1243,15 +1286,885 @@ class DataGenerator(unittest.TestCase):
             < 0.01
         )
 
-        os.remove("tests/out/white_background.jpg")
-
     def test_generate_data_with_quasicrystal_background(self):
         bkgd = background_generator.quasicrystal(64, 128)
 
         self.assertTrue(len(bkgd.histogram()) > 20 and bkgd.size == (128, 64))
 
+    def test_font_size_for_height(self):
+        for skewing_angle, distorsion_type in [(0, 0), (5, 0), (3, 1)]:
+            font_size = computer_text_generator.font_size_for_height(
+                "TEST TEST TEST",
+                "tests/font.ttf",
+                64,
+                22,
+                skewing_angle,
+                distorsion_type,
+            )
+            img, _, _ = computer_text_generator.generate(
+                "TEST TEST TEST",
+                "tests/font.ttf",
+                "#010101",
+                font_size,
+                0,
+                1,
+                0,
+                False,
+                False,
+            )
+            height = img.rotate(skewing_angle, expand=1).size[1]
+            if distorsion_type != 0:
+                height += 2 * int(height**0.5)
+            self.assertLessEqual(abs(height - 22), 3)
+
+    def test_generate_data_with_direct_render(self):
+        img, _ = FakeTextDataGenerator.generate(
+            24,
+            "TEST TEST TEST",
+            "tests/font.ttf",
+            None,
+            32,
+            None,
+            5,
+            False,
+            0,
+            False,
+            1,
+            0,
+            0,
+            False,
+            0,
+            -1,
+            0,
+            "#010101",
+            0,
+            1,
+            0,
+            [(5, 5, 5, 5)],
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            direct_render=True,
+        )
+
+        self.assertEqual(img.size[1], 32)
+
+    def test_generate_paragraph_with_annotations(self):
+        img, meta_data = FakeTextDataGenerator.generate(
+            25,
+            "TEST TEST TEST " * 60,
+            "tests/font.ttf",
+            None,
+            32,
+            None,
+            0,
+            False,
+            0,
+            False,
+            1,
+            0,
+            0,
+            False,
+            0,
+            -1,
+            0,
+            "#010101",
+            2,
+            1,
+            0,
+            (5, 5, 5, 5),
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            output_annotations=True,
+        )
+
+        lines = meta_data["annotations"]["lines"]
+        self.assertGreater(len(lines), 1)
+        for line in lines:
+            self.assertEqual(
+                [w["text"] for w in line["words"]], line["text"].split()
+            )
+            x1, y1, x2, y2 = line["bbox"]
+            self.assertTrue(0 <= x1 < x2 < img.size[0] and 0 <= y1 < y2 < img.size[1])
+
+    def test_generate_paragraph_with_line_crops(self):
+        img, meta_data = FakeTextDataGenerator.generate(
+            26,
+            "TEST TEST TEST " * 60,
+            "tests/font.ttf",
+            None,
+            32,
+            None,
+            0,
+            False,
+            0,
+            False,
+            1,
+            0,
+            0,
+            False,
+            0,
+            -1,
+            0,
+            "#010101",
+            2,
+            1,
+            0,
+            (5, 5, 5, 5),
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            line_crops=True,
+        )
+
+        crops = meta_data["line_crops"]
+        self.assertGreater(len(crops), 1)
+        for crop, label in crops:
+            self.assertEqual(label.split(), ["TEST"] * len(label.split()))
+            self.assertLess(crop.size[1], img.size[1])
+
+    def test_generate_data_with_variants_per_render(self):
+        results = FakeTextDataGenerator.generate(
+            27,
+            "TEST TEST TEST",
+            "tests/font.ttf",
+            None,
+            64,
+            None,
+            10,
+            True,
+            0,
+            False,
+            1,
+            1,
+            0,
+            False,
+            0,
+            -1,
+            0,
+            "#010101",
+            0,
+            1,
+            0,
+            [(5, 5, 5, 5), (0, 10, 0, 10)],
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            variants_per_render=4,
+        )
+
+        self.assertEqual(len(results), 4)
+        for img, meta_data in results:
+            self.assertEqual(img.size[1], 64)
+            self.assertEqual(meta_data["text"], "TEST TEST TEST")
+
+    def test_generate_data_with_pyramid(self):
+        img, meta_data = FakeTextDataGenerator.generate(
+            28,
+            "TEST TEST TEST",
+            "tests/font.ttf",
+            None,
+            64,
+            None,
+            5,
+            False,
+            0,
+            False,
+            1,
+            0,
+            0,
+            False,
+            0,
+            -1,
+            0,
+            "#010101",
+            0,
+            1,
+            0,
+            (5, 5, 5, 5),
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            output_bboxes=3,
+            pyramid_sizes=[32, 48, 64],
+        )
+
+        self.assertEqual(meta_data["pyramid"][64], img)
+        for height in (32, 48):
+            level = meta_data["pyramid"][height]
+            self.assertEqual(level.size[1], height)
+            self.assertTrue(
+                np.allclose(
+                    np.array(meta_data["pyramid_bboxes"][height]),
+                    np.array(meta_data["bboxes"]) * height / 64,
+                    atol=1,
+                )
+            )
+
+    def test_generate_page(self):
+        texts = ["TEST TEST {}".format(i) for i in range(12)]
+        results = FakeTextDataGenerator.generate_page(
+            100,
+            texts,
+            ["tests/font.ttf"] * len(texts),
+            None,
+            32,
+            None,
+            3,
+            True,
+            0,
+            False,
+            1,
+            0,
+            0,
+            0,
+            300,
+            "#010101",
+            1,
+            0,
+            (5, 5, 5, 5),
+            False,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+        )
+
+        self.assertEqual([m["text"] for _, m in results], texts)
+        for img, _ in results:
+            self.assertEqual(img.size[1], 32)
+
+    def test_generate_batch(self):
+        texts = ["TEST", "TEST TEST", "TEST TEST TEST"]
+        images, widths, labels = FakeTextDataGenerator.generate_batch(
+            texts,
+            ["tests/font.ttf"] * len(texts),
+            32,
+            0,
+            False,
+            0,
+            False,
+            1,
+            0,
+            0,
+            "#010101",
+            1,
+            0,
+            (5, 5, 5, 5),
+            False,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+            image_mode="L",
+        )
+
+        self.assertEqual(labels, texts)
+        self.assertEqual(images.dtype, np.uint8)
+        self.assertEqual(images.shape, (3, 32, widths.max(), 1))
+        self.assertTrue(widths[0] < widths[1] < widths[2])
+        self.assertFalse(images[0, :, widths[0] :].any())
+        self.assertTrue((images[0, :5, : widths[0]] == 255).all())
+
+    def test_generate_data_with_seed_in_threads(self):
+        def generate(seed):
+            img, _ = FakeTextDataGenerator.generate(
+                0,
+                "TEST TEST TEST",
+                "tests/font.ttf",
+                None,
+                48,
+                "png",
+                5,
+                True,
+                2,
+                True,
+                0,
+                3,
+                2,
+                False,
+                0,
+                -1,
+                0,
+                "#000000,#888888",
+                0,
+                1.0,
+                0,
+                (5, 5, 5, 5),
+                False,
+                False,
+                False,
+                "",
+                blured_data_percetage=1.0,
+                seed=seed,
+            )
+            return np.asarray(img)
+
+        with ThreadPool(4) as pool:
+            images = pool.map(generate, [i % 2 for i in range(8)])
+
+        for i, img in enumerate(images):
+            self.assertTrue(np.array_equal(img, images[i % 2]))
+        self.assertFalse(
+            images[0].shape == images[1].shape and np.array_equal(images[0], images[1])
+        )
+
+    def test_generate_data_with_stage_timer(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        try:
+            _, recorded = profiling.profiled_call(
+                FakeTextDataGenerator.generate_from_tuple,
+                (
+                    0,
+                    "TEST TEST TEST",
+                    "tests/font.ttf",
+                    directory,
+                    64,
+                    "jpg",
+                    5,
+                    False,
+                    1,
+                    False,
+                    0,
+                    1,
+                    0,
+                    False,
+                    0,
+                    -1,
+                    0,
+                    "#010101",
+                    0,
+                    1,
+                    0,
+                    (5, 5, 5, 5),
+                    0,
+                    0,
+                    False,
+                    os.path.join(
+                        os.path.split(os.path.realpath(__file__))[0], "trdg/images"
+                    ),
+                    0,
+                    "#282828",
+                    "RGB",
+                    0,
+                    1.0,
+                ),
+                trace=True,
+                memory=True,
+                describe=lambda t: "horizontal",
+            )
+        finally:
+            profiling.timer.enabled = False
+            profiling.timer.trace = False
+            profiling.timer.memory = False
+            tracemalloc.stop()
+
+        durations, spans = recorded["durations"], recorded["spans"]
+
+        for stage in [
+            "generate",
+            "render",
+            "rotate",
+            "distort_field",
+            "distort",
+            "background",
+            "contrast",
+            "paste",
+            "convert",
+            "blur",
+            "name",
+            "encode",
+            "write",
+        ]:
+            self.assertEqual(len(durations[stage]), 1)
+        self.assertTrue(
+            os.path.exists(os.path.join(directory, "TEST TEST TEST_0.jpg"))
+        )
+
+        self.assertEqual(len(spans), sum([len(v) for v in durations.values()]))
+        self.assertEqual({span[-1] for span in spans}, {0})
+
+        self.assertEqual(recorded["peaks"].keys(), durations.keys())
+        self.assertEqual(len(recorded["sample_peaks"]["horizontal"]), 1)
+        self.assertGreaterEqual(
+            recorded["sample_peaks"]["horizontal"][0], max(recorded["peaks"]["render"])
+        )
+        self.assertGreater(recorded["rss"][os.getpid()], 0)
+
+        stage_timer = profiling.StageTimer()
+        stage_timer.merge(recorded)
+        stage_timer.merge(recorded)
+        self.assertEqual(stage_timer.summary()["render"]["count"], 2)
+        self.assertEqual(
+            stage_timer.memory_summary()["samples"]["horizontal"]["count"], 2
+        )
+
+        trace_path = os.path.join(directory, "trace.json")
+        stage_timer.write_trace(trace_path, min([s[1] for s in spans]))
+        with open(trace_path) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(len([e for e in events if e["ph"] == "X"]), 2 * len(spans))
+        self.assertEqual(min([e["ts"] for e in events if e["ph"] == "X"]), 0)
+        self.assertEqual(profiling.timer.stage("render"), profiling._NULL_STAGE)
+
+    def test_generate_data_with_cprofile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        try:
+            for i in range(2):
+                profiling.cprofiled_call(
+                    FakeTextDataGenerator.generate_from_tuple,
+                    directory,
+                    (
+                        i,
+                        "TEST TEST TEST",
+                        "tests/font.ttf",
+                        directory,
+                        32,
+                        "jpg",
+                        0,
+                        False,
+                        0,
+                        False,
+                        1,
+                        0,
+                        0,
+                        False,
+                        0,
+                        -1,
+                        0,
+                        "#010101",
+                        0,
+                        1,
+                        0,
+                        (5, 5, 5, 5),
+                        0,
+                        0,
+                        False,
+                        "",
+                    ),
+                )
+            profiling.dump_profiles(directory)
+        finally:
+            profiling._profilers.clear()
+
+        with open(profiling.write_profile_report(directory)) as f:
+            report = f.read()
+        self.assertIn("generate_from_tuple", report)
+        with open(os.path.join(directory, "stacks.folded")) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(
+            any(s.startswith("generate_from_tuple (data_generator.py") for s in stacks)
+        )
+        for stack in stacks:
+            self.assertTrue(stack.rsplit(" ", 1)[1].isdigit())
+
+    def test_generate_data_with_counters(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        metrics.counters.drain()
+        _, counts = metrics.counted_call(
+            FakeTextDataGenerator.generate_from_tuple,
+            False,
+            (
+                0,
+                "TEST TEST TEST",
+                "tests/font.ttf",
+                directory,
+                32,
+                "jpg",
+                0,
+                False,
+                0,
+                False,
+                1,
+                0,
+                0,
+                False,
+                0,
+                -1,
+                0,
+                "#010101",
+                0,
+                1,
+                0,
+                (5, 5, 5, 5),
+                0,
+                0,
+                False,
+                os.path.join(
+                    os.path.split(os.path.realpath(__file__))[0], "trdg/images"
+                ),
+            ),
+        )
+        self.assertEqual(counts, {"written": 1})
+
+        black = Image.new("RGB", (10, 10), (0, 0, 0))
+        self.assertTrue(
+            FakeTextDataGenerator._low_contrast(
+                black.convert("RGBA"), Image.new("RGB", (10, 10), (0, 0, 255)), black
+            )
+        )
+        self.assertEqual(metrics.counters.drain(), {"low_contrast": 1})
+
+        counters = metrics.Counters()
+        counters.merge(counts)
+        counters.merge({"written": 1, "font_fallback": 2})
+        self.assertEqual(
+            counters.summary(),
+            {
+                "written": 2,
+                "low_contrast": 0,
+                "resampled": 0,
+                "font_fallback": 2,
+                "error": 0,
+            },
+        )
+
+    def test_generate_data_with_max_resamples(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        args = (
+            0,
+            "TEST TEST TEST",
+            "tests/font.ttf",
+            directory,
+            32,
+            "jpg",
+            0,
+            False,
+            0,
+            False,
+            4,
+            0,
+            0,
+            False,
+            2,
+            -1,
+            0,
+            "#FFFFFF",
+            0,
+            1,
+            0,
+            (5, 5, 5, 5),
+            0,
+            0,
+            False,
+            os.path.join(os.path.split(os.path.realpath(__file__))[0], "trdg/images"),
+        )
+        # White text is too close to some of the background images
+        seed = next(
+            seed
+            for seed in range(100)
+            if FakeTextDataGenerator.generate(*args, seed=seed) is None
+        )
+        metrics.counters.drain()
+
+        meta_data = FakeTextDataGenerator.generate(*args, seed=seed, max_resamples=10)
+        self.assertEqual(meta_data["index"], 0)
+        self.assertTrue(os.path.exists(os.path.join(directory, "0.jpg")))
+        counts = metrics.counters.drain()
+        self.assertEqual(counts["written"], 1)
+        self.assertGreaterEqual(counts["resampled"], 1)
+        self.assertEqual(counts["resampled"], counts["low_contrast"])
+
+    def test_contrast_precheck(self):
+        image_dir = os.path.join(
+            os.path.split(os.path.realpath(__file__))[0], "trdg/images"
+        )
+        self.assertEqual(
+            computer_text_generator.pick_color("#D7D7D7,#D7D7D7"), "#d7d7d7"
+        )
+
+        # Near-white text is too close to white and gaussian noise, light
+        # grey text to containers.jpg (luminance 194) but not to the others
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#F5F5F5", 1, image_dir),
+            (False, None),
+        )
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#F5F5F5", 0, image_dir),
+            (False, None),
+        )
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#D7D7D7", 1, image_dir),
+            (True, None),
+        )
+        passes, images = FakeTextDataGenerator._contrast_precheck(
+            "#C2C2C2", 4, image_dir
+        )
+        self.assertTrue(passes)
+        self.assertNotIn("containers.jpg", images)
+        self.assertEqual(len(images), len(os.listdir(image_dir)) - 1)
+
+        # The check on the final pixels agrees with the pre-check
+        text = Image.new("RGBA", (10, 10), (245, 245, 245, 255))
+        mask = Image.new("RGB", (10, 10), (0, 0, 1))
+        self.assertTrue(
+            FakeTextDataGenerator._low_contrast(
+                text, mask, background_generator.plain_white(10, 10)
+            )
+        )
+        self.assertFalse(
+            FakeTextDataGenerator._low_contrast(
+                text, mask, Image.new("RGB", (10, 10), (40, 40, 40))
+            )
+        )
+
+        background = FakeTextDataGenerator._background(
+            4, 32, 100, image_dir, images=["city.jpg"]
+        )
+        self.assertEqual(background.size, (100, 32))
+
+    def test_contrast_precheck_with_other_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        open(os.path.join(directory, ".gitkeep"), "w").close()
+        os.mkdir(os.path.join(directory, "more.jpg"))
+        with open(os.path.join(directory, "broken.jpg"), "w") as f:
+            f.write("not an image")
+        # A palette image is measured by color, not by palette index
+        palette = Image.new("P", (10, 10), 1)
+        palette.putpalette([0, 0, 0, 250, 250, 250])
+        palette.save(os.path.join(directory, "palette.png"))
+
+        self.assertEqual(
+            sorted(background_generator.image_names(directory)),
+            ["broken.jpg", "palette.png"],
+        )
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#F5F5F5", 4, directory),
+            (False, []),
+        )
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#000000", 4, directory),
+            (True, ["palette.png"]),
+        )
+
+        # Files added later are seen, force a new mtime for coarse clocks
+        Image.new("RGB", (10, 10)).save(os.path.join(directory, "black.png"))
+        mtime = os.stat(directory).st_mtime_ns
+        os.utime(directory, ns=(mtime, mtime + 1))
+        self.assertEqual(
+            FakeTextDataGenerator._contrast_precheck("#F5F5F5", 4, directory),
+            (True, ["black.png"]),
+        )
+
+    def test_wrap_text_by_pixels(self):
+        font = ImageFont.truetype("tests/font.ttf", 32)
+        text = " ".join(create_strings_from_file("tests/test.txt", 20))
+        lines = computer_text_generator.wrap_text_by_pixels(text, font, 400, 100)
+
+        self.assertEqual(" ".join(lines).split(), text.split())
+        for line, next_line in zip(lines, lines[1:]):
+            self.assertLessEqual(computer_text_generator.get_text_width(font, line), 400)
+            self.assertGreater(
+                computer_text_generator.get_text_width(
+                    font, line + " " + next_line.split()[0]
+                ),
+                400,
+            )
+
+
+class GeometryGenerator(unittest.TestCase):
+    def _render(self):
+        return computer_text_generator.generate(
+            "TEST TEST TEST", "tests/font.ttf", "#010101", 64, 0, 1, 0, False, False
+        )[:2]
+
+    def test_rotation_matrix_matches_pil(self):
+        img, _ = self._render()
+        for angle in [0, 5, -13, 90]:
+            _, size = geometry_generator.rotation_matrix(img.size, angle)
+            self.assertEqual(size, img.rotate(angle, expand=1).size)
+
+    def test_fused_transform_matches_chain(self):
+        img, mask = self._render()
+        height = 54
+
+        for angle, distorsion_type, vertical, horizontal in [
+            (0, 1, True, False),
+            (5, 0, False, False),
+            (-5, 2, False, True),
+            (7, 1, True, True),
+        ]:
+            rotated_img = img.rotate(angle, expand=1)
+            rotated_mask = mask.rotate(angle, expand=1)
+            if distorsion_type == 0:
+                distorted_img, distorted_mask = rotated_img, rotated_mask
+            else:
+                distorted_img, distorted_mask = (
+                    distorsion_generator.sin
+                    if distorsion_type == 1
+                    else distorsion_generator.cos
+                )(rotated_img, rotated_mask, vertical=vertical, horizontal=horizontal)
+            new_size = (
+                int(distorted_img.size[0] * (height / distorted_img.size[1])),
+                height,
+            )
+            chain_img = distorted_img.resize(new_size, Image.Resampling.LANCZOS)
+            chain_mask = distorted_mask.resize(new_size, Image.Resampling.NEAREST)
+
+            fused_img, fused_mask = geometry_generator.fused_transform(
+                img,
+                mask,
+                angle,
+                distorsion_type,
+                vertical,
+                horizontal,
+                lambda w, h: (int(w * (height / h)), height),
+            )
+
+            self.assertEqual(fused_img.size, chain_img.size)
+            self.assertEqual(fused_mask.size, chain_mask.size)
+            # Mean absolute difference of the alpha channel, in [0, 255]
+            self.assertLess(
+                np.abs(
+                    np.asarray(fused_img, dtype=np.float64)[..., 3]
+                    - np.asarray(chain_img, dtype=np.float64)[..., 3]
+                ).mean(),
+                8,
+            )
+            self.assertGreater(
+                (np.asarray(fused_mask) == np.asarray(chain_mask)).all(-1).mean(),
+                0.97,
+            )
+
+    def test_transform_points_follow_the_mask(self):
+        img, mask, meta_data = computer_text_generator.generate(
+            "TEST", "tests/font.ttf", "#010101", 64, 0, 1, 0, False, False
+        )
+        _, rotated_size = geometry_generator.rotation_matrix(img.size, 7)
+        field = geometry_generator.distorsion_field(1, rotated_size, True, True)
+        _, distorted_mask = geometry_generator.fused_transform(
+            img, mask, 7, 1, True, True, None, field
+        )
+        quads = geometry_generator.transform_points(
+            meta_data["boxes"], img.size, 7, field, distorted_mask.size
+        )
+
+        mask_arr = np.asarray(distorted_mask)
+        for i, quad in enumerate(quads):
+            ys, xs = np.where(np.all(mask_arr == (0, 0, i + 1), axis=-1))
+            self.assertGreater(len(xs), 0)
+            self.assertGreaterEqual(xs.min(), quad[:, 0].min() - 2)
+            self.assertLessEqual(xs.max(), quad[:, 0].max() + 2)
+            self.assertGreaterEqual(ys.min(), quad[:, 1].min() - 2)
+            self.assertLessEqual(ys.max(), quad[:, 1].max() + 2)
+
+
+class SampleServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "trdg.sock")
+        self.server = sample_server.SampleServer(
+            self.socket_path, 1, 2, ["tests", self.directory]
+        )
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.server.serve())
+
+        def serve():
+            try:
+                self.loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                pass
+
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        for _ in range(50):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        self.loop.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_sample_server(self):
+        client = sample_server.SampleClient(
+            self.socket_path,
+            generator="strings",
+            strings=["TEST TEST"],
+            fonts=["tests/font.ttf"],
+            count=3,
+            size=48,
+        )
+        samples = list(client)
+        self.assertEqual([lbl for _, lbl in samples], ["TEST TEST"] * 3)
+        for (img, meta_data), _ in samples:
+            self.assertEqual(img.size[1], 48)
+
+        self.assertRaises(
+            RuntimeError,
+            list,
+            sample_server.SampleClient(self.socket_path, generator="?"),
+        )
+        # Clients cannot read files outside of the allowed directories
+        self.assertRaises(
+            RuntimeError,
+            list,
+            sample_server.SampleClient(
+                self.socket_path,
+                generator="strings",
+                strings=["TEST TEST"],
+                fonts=["tests/../trdg/server.py"],
+            ),
+        )
+        self.assertRaises(
+            RuntimeError,
+            list,
+            sample_server.SampleClient(
+                self.socket_path, generator="dict", language="../../tests/test"
+            ),
+        )
+        # The render fails in the worker, not in the configuration
+        self.assertRaises(
+            RuntimeError,
+            list,
+            sample_server.SampleClient(
+                self.socket_path,
+                generator="strings",
+                strings=["TEST TEST"],
+                fonts=["tests/font.ttf"],
+                count=3,
+                background_type=4,
+                image_dir=os.path.join(self.directory, "missing"),
+            ),
+        )
+
 
 class CommandLineInterface(unittest.TestCase):
+    def test_task_seed(self):
+        self.assertEqual(run.task_seed(7, 3), run.task_seed(7, 3))
+        self.assertNotEqual(run.task_seed(7, 3), run.task_seed(7, 4))
+        self.assertNotEqual(run.task_seed(7, 3), run.task_seed(8, 2))
+
+    def test_read_journal(self):
+        path = "tests/out/progress.jsonl"
+        with open(path, "w", encoding="utf8") as f:
+            f.write(json.dumps({"seed": 7, "args": {"count": 4}}) + "\n")
+            f.write(json.dumps({"index": 2, "samples": [[2, "2.jpg", "b"]]}) + "\n")
+            f.write(json.dumps({"index": 0, "samples": []}) + "\n")
+            # Cut by a crash
+            f.write('{"index": 1, "sam')
+
+        header, done = run.read_journal(path)
+        self.assertEqual(header, {"seed": 7, "args": {"count": 4}})
+        self.assertEqual(done, {2: [[2, "2.jpg", "b"]], 0: []})
+        with open(path, encoding="utf8") as f:
+            self.assertTrue(f.read().endswith('"samples": []}\n'))
+        os.remove(path)
+
     def test_output_dir(self):
         args = ["python3", "run.py", "-c", "1", "--output_dir", "../tests/out_2/"]
         subprocess.Popen(args, cwd="trdg/").wait()
@@ -1,13 +1,18 @@
 import cv2
+import functools
 import math
 import os
 import random as rnd
+from typing import List, Optional, Tuple
+
 import numpy as np
 
-from PIL import Image, ImageDraw, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter, ImageStat
+
+from trdg.metrics import counters
 
 
-def gaussian_noise(height: int, width: int) -> Image:
+def gaussian_noise(height: int, width: int, rng: rnd.Random = rnd) -> Image:
     """
     Create a background with Gaussian noise (to mimic paper)
     """
@@ -15,12 +20,30 @@ def gaussian_noise(height: int, width: int) -> Image:
     # We create an all white image
     image = np.ones((height, width)) * 255
 
-    # We add gaussian noise
+    # We add gaussian noise, OpenCV's generator is per thread and is seeded
+    # from rng so that the noise follows it
+    cv2.setRNGSeed(rng.randrange(2**31))
     cv2.randn(image, 235, 10)
 
     return Image.fromarray(image).convert("RGBA")
 
 
+def gaussian_noise_batch(
+    count: int, height: int, width: int, rng: rnd.Random = rnd
+) -> np.ndarray:
+    """
+    Create count backgrounds with Gaussian noise at once, as one
+    (count, height, width) grayscale array
+    """
+
+    image = np.empty((count * height, width))
+
+    cv2.setRNGSeed(rng.randrange(2**31))
+    cv2.randn(image, 235, 10)
+
+    return np.clip(image, 0, 255).astype(np.uint8).reshape(count, height, width)
+
+
 def plain_white(height: int, width: int) -> Image:
     """
     Create a plain white background
@@ -29,41 +52,86 @@ def plain_white(height: int, width: int) -> Image:
     return Image.new("L", (width, height), 255).convert("RGBA")
 
 
-def quasicrystal(height: int, width: int) -> Image:
+def quasicrystal(height: int, width: int, rng: rnd.Random = rnd) -> Image:
     """
     Create a background with quasicrystal (https://en.wikipedia.org/wiki/Quasicrystal)
     """
 
-    image = Image.new("L", (width, height))
-    pixels = image.load()
-
-    frequency = rnd.random() * 30 + 20  # frequency
-    phase = rnd.random() * 2 * math.pi  # phase
-    rotation_count = rnd.randint(10, 20)  # of rotations
-
-    for kw in range(width):
-        y = float(kw) / (width - 1) * 4 * math.pi - 2 * math.pi
-        for kh in range(height):
-            x = float(kh) / (height - 1) * 4 * math.pi - 2 * math.pi
-            z = 0.0
-            for i in range(rotation_count):
-                r = math.hypot(x, y)
-                a = math.atan2(y, x) + i * math.pi * 2.0 / rotation_count
-                z += math.cos(r * math.sin(a) * frequency + phase)
-            c = int(255 - round(255 * z / rotation_count))
-            pixels[kw, kh] = c  # grayscale
+    frequency = rng.random() * 30 + 20  # frequency
+    phase = rng.random() * 2 * math.pi  # phase
+    rotation_count = rng.randint(10, 20)  # of rotations
+
+    # The whole pixel grid is computed at once, one rotation at a time
+    y = np.arange(width, dtype=np.float64) / (width - 1) * 4 * math.pi - 2 * math.pi
+    x = np.arange(height, dtype=np.float64) / (height - 1) * 4 * math.pi - 2 * math.pi
+    x, y = np.meshgrid(x, y, indexing="ij")
+    r = np.hypot(x, y)
+    theta = np.arctan2(y, x)
+    z = np.zeros((height, width), dtype=np.float64)
+    for i in range(rotation_count):
+        a = theta + i * math.pi * 2.0 / rotation_count
+        z += np.cos(r * np.sin(a) * frequency + phase)
+    c = 255 - np.round(255 * z / rotation_count)
+
+    image = Image.fromarray(np.clip(c, 0, 255).astype(np.uint8), "L")
     return image.convert("RGBA")
 
 
-def image(height: int, width: int, image_dir: str) -> Image:
+# Files of an image directory that are used as backgrounds
+IMAGE_EXTENSIONS = (".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp")
+
+
+def image_names(image_dir: str) -> Tuple[str]:
+    """
+    File names of the background images of a directory, listed again only
+    when the directory changes
+    """
+
+    return _image_names(image_dir, os.stat(image_dir).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _image_names(image_dir: str, mtime: int) -> Tuple[str]:
+    return tuple(
+        name
+        for name in os.listdir(image_dir)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        and os.path.isfile(os.path.join(image_dir, name))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def image_mean(path: str) -> Optional[List[float]]:
+    """
+    Mean of the RGB channels of a background image, read once per file. None
+    if the file cannot be read as an image.
+    """
+
+    try:
+        with Image.open(path) as pic:
+            return ImageStat.Stat(pic.convert("RGB")).mean
+    except OSError as err:
+        counters.log("Cannot read background image {}: {}".format(path, err))
+        return None
+
+
+def image(
+    height: int,
+    width: int,
+    image_dir: str,
+    rng: rnd.Random = rnd,
+    images: List[str] = None,
+) -> Image:
     """
-    Create a background with a image
+    Create a background with a image, picked from images (all the image
+    files of image_dir by default)
     """
-    images = os.listdir(image_dir)
+    if images is None:
+        images = image_names(image_dir)
 
     if len(images) > 0:
         pic = Image.open(
-            os.path.join(image_dir, images[rnd.randint(0, len(images) - 1)])
+            os.path.join(image_dir, images[rng.randint(0, len(images) - 1)])
         )
 
         if pic.size[0] < width:
@@ -80,11 +148,11 @@ def image(height: int, width: int, image_dir: str) -> Image:
         if pic.size[0] == width:
             x = 0
         else:
-            x = rnd.randint(0, pic.size[0] - width)
+            x = rng.randint(0, pic.size[0] - width)
         if pic.size[1] == height:
             y = 0
         else:
-            y = rnd.randint(0, pic.size[1] - height)
+            y = rng.randint(0, pic.size[1] - height)
 
         return pic.crop((x, y, x + width, y + height))
     else:
@@ -1,7 +1,11 @@
 import random as rnd
 from typing import Tuple
+
+import numpy as np
 from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont
 
+from trdg import distorsion_generator, geometry_generator
+from trdg.metrics import counters
 from trdg.utils import get_text_width, get_text_height
 
 import textwrap
@@ -34,6 +38,7 @@ def generate(
     word_split: bool,
     stroke_width: int = 0,
     stroke_fill: str = "#282828",
+    rng: rnd.Random = rnd,
 ) -> Tuple:
     if orientation == 0:
         return _generate_horizontal_text(
@@ -47,6 +52,7 @@ def generate(
             word_split,
             stroke_width,
             stroke_fill,
+            rng=rng,
         )
     elif orientation == 1:
         return _generate_vertical_text(
@@ -59,6 +65,7 @@ def generate(
             fit,
             stroke_width,
             stroke_fill,
+            rng=rng,
         )
     elif orientation == 2:
         return _generate_paragraph_text(
@@ -71,11 +78,26 @@ def generate(
             fit,
             stroke_width,
             stroke_fill,
+            rng=rng,
         )
     else:
         raise ValueError("Unknown orientation " + str(orientation))
 
 
+def pick_color(text_color: str, rng: rnd.Random = rnd) -> str:
+    """
+    Draw one color from a text color range ("#000000,#888888") the same way
+    the text is colored, so that it can be known before rendering
+    """
+
+    colors = [ImageColor.getrgb(c) for c in text_color.split(",")]
+    c1, c2 = colors[0], colors[-1]
+
+    return "#{:02x}{:02x}{:02x}".format(
+        *[rng.randint(min(a, b), max(a, b)) for a, b in zip(c1[:3], c2[:3])]
+    )
+
+
 def _compute_character_width(image_font: ImageFont, character: str) -> int:
     if len(character) == 1 and (
         "{0:#x}".format(ord(character))
@@ -86,20 +108,42 @@ def _compute_character_width(image_font: ImageFont, character: str) -> int:
     return round(image_font.getlength(character))
 
 
-def _generate_horizontal_text(
+def _piece_box(
+    image_font: ImageFont,
+    piece: str,
+    x: int,
+    y: int,
+    stroke_width: int,
+    blank_size: Tuple[int, int],
+) -> list:
+    """
+    Corners (clockwise from the top-left) of the box of a piece of text drawn
+    at (x, y). Blank pieces get the box of the space they take in the layout.
+    """
+    if piece.strip():
+        left, top, right, bottom = image_font.getbbox(piece, stroke_width=stroke_width)
+    else:
+        left, top, right, bottom = 0, 0, blank_size[0], blank_size[1]
+
+    return [
+        (x + left, y + top),
+        (x + right, y + top),
+        (x + right, y + bottom),
+        (x + left, y + bottom),
+    ]
+
+
+def _horizontal_layout(
+    image_font: ImageFont,
     text: str,
-    font: str,
-    text_color: str,
-    font_size: int,
     space_width: int,
     character_spacing: int,
-    fit: bool,
     word_split: bool,
-    stroke_width: int = 0,
-    stroke_fill: str = "#282828",
 ) -> Tuple:
-    image_font = ImageFont.truetype(font=font, size=font_size)
-
+    """
+    Split horizontal text in pieces and measure them. Returns the pieces,
+    their widths and the size of the whole text.
+    """
     space_width = int(get_text_width(image_font, " ") * space_width)
 
     if word_split:
@@ -121,6 +165,123 @@ def _generate_horizontal_text(
 
     text_height = max([get_text_height(image_font, p) for p in splitted_text])
 
+    return splitted_text, piece_widths, text_width, text_height
+
+
+def font_size_for_height(
+    text: str,
+    font: str,
+    font_size: int,
+    target_height: int,
+    skewing_angle: float = 0,
+    distorsion_type: int = 0,
+    space_width: int = 1,
+    character_spacing: int = 0,
+    word_split: bool = False,
+    fit: bool = False,
+) -> int:
+    """
+    Find the font size at which horizontal text, once skewed and vertically
+    distorted, is about target_height pixels high. The glyph metrics are
+    measured once at font_size and scaled, nothing is rendered.
+    """
+    image_font = ImageFont.truetype(font=font, size=font_size)
+
+    if fit:
+        left, top, right, bottom = image_font.getbbox(text)
+        text_width, text_height = right - left, bottom - top
+    else:
+        _, _, text_width, text_height = _horizontal_layout(
+            image_font, text, space_width, character_spacing, word_split
+        )
+
+    if text_width <= 0 or text_height <= 0:
+        return font_size
+
+    def predicted_height(scale):
+        _, (_, height) = geometry_generator.rotation_matrix(
+            (max(int(text_width * scale), 1), max(int(text_height * scale), 1)),
+            skewing_angle,
+        )
+        if distorsion_type != 0:
+            height += 2 * distorsion_generator.distorsion_function(
+                distorsion_type, height
+            )[0]
+        return height
+
+    # The skewed height grows with the width and the distortion adds a
+    # margin depending on that height, so refine the scale a few times
+    scale = target_height / text_height
+    for _ in range(4):
+        scale *= target_height / predicted_height(scale)
+
+    # The distortion margin is a step function, settle on the closest size
+    best_size = max(int(round(font_size * scale)), 1)
+    return min(
+        range(max(best_size - 1, 1), best_size + 2),
+        key=lambda s: abs(predicted_height(s / font_size) - target_height),
+    )
+
+
+def predict_width(
+    text: str,
+    font: str,
+    font_size: int,
+    target_height: int,
+    skewing_angle: float = 0,
+    distorsion_type: int = 0,
+    space_width: int = 1,
+    character_spacing: int = 0,
+    word_split: bool = False,
+    fit: bool = False,
+) -> int:
+    """
+    Predict the width of horizontal text once skewed, vertically distorted
+    and resized to target_height pixels high, from the glyph metrics only
+    """
+    image_font = ImageFont.truetype(font=font, size=font_size)
+
+    if fit:
+        left, top, right, bottom = image_font.getbbox(text)
+        text_width, text_height = right - left, bottom - top
+    else:
+        _, _, text_width, text_height = _horizontal_layout(
+            image_font, text, space_width, character_spacing, word_split
+        )
+
+    if text_width <= 0 or text_height <= 0:
+        return 1
+
+    _, (width, height) = geometry_generator.rotation_matrix(
+        (text_width, text_height), skewing_angle
+    )
+    if distorsion_type != 0:
+        height += 2 * distorsion_generator.distorsion_function(
+            distorsion_type, height
+        )[0]
+
+    return max(int(width * target_height / height), 1)
+
+
+def _generate_horizontal_text(
+    text: str,
+    font: str,
+    text_color: str,
+    font_size: int,
+    space_width: int,
+    character_spacing: int,
+    fit: bool,
+    word_split: bool,
+    stroke_width: int = 0,
+    stroke_fill: str = "#282828",
+    rng: rnd.Random = rnd,
+) -> Tuple:
+    image_font = ImageFont.truetype(font=font, size=font_size)
+
+    splitted_text, piece_widths, text_width, text_height = _horizontal_layout(
+        image_font, text, space_width, character_spacing, word_split
+    )
+
     txt_img = Image.new("RGBA", (text_width, text_height), (0, 0, 0, 0))
     txt_mask = Image.new("RGB", (text_width, text_height), (0, 0, 0))
 
@@ -132,21 +293,32 @@ def _generate_horizontal_text(
     c1, c2 = colors[0], colors[-1]
 
     fill = (
-        rnd.randint(min(c1[0], c2[0]), max(c1[0], c2[0])),
-        rnd.randint(min(c1[1], c2[1]), max(c1[1], c2[1])),
-        rnd.randint(min(c1[2], c2[2]), max(c1[2], c2[2])),
+        rng.randint(min(c1[0], c2[0]), max(c1[0], c2[0])),
+        rng.randint(min(c1[1], c2[1]), max(c1[1], c2[1])),
+        rng.randint(min(c1[2], c2[2]), max(c1[2], c2[2])),
     )
 
     stroke_colors = [ImageColor.getrgb(c) for c in stroke_fill.split(",")]
     stroke_c1, stroke_c2 = stroke_colors[0], stroke_colors[-1]
 
     stroke_fill = (
-        rnd.randint(min(stroke_c1[0], stroke_c2[0]), max(stroke_c1[0], stroke_c2[0])),
-        rnd.randint(min(stroke_c1[1], stroke_c2[1]), max(stroke_c1[1], stroke_c2[1])),
-        rnd.randint(min(stroke_c1[2], stroke_c2[2]), max(stroke_c1[2], stroke_c2[2])),
+        rng.randint(min(stroke_c1[0], stroke_c2[0]), max(stroke_c1[0], stroke_c2[0])),
+        rng.randint(min(stroke_c1[1], stroke_c2[1]), max(stroke_c1[1], stroke_c2[1])),
+        rng.randint(min(stroke_c1[2], stroke_c2[2]), max(stroke_c1[2], stroke_c2[2])),
     )
 
+    boxes = []
     for i, p in enumerate(splitted_text):
+        boxes.append(
+            _piece_box(
+                image_font,
+                p,
+                sum(piece_widths[0:i]) + i * character_spacing * int(not word_split),
+                0,
+                stroke_width,
+                (piece_widths[i], text_height),
+            )
+        )
         txt_img_draw.text(
             (sum(piece_widths[0:i]) + i * character_spacing * int(not word_split), 0),
             p,
@@ -164,10 +336,19 @@ def _generate_horizontal_text(
             stroke_fill=stroke_fill,
         )
 
+    meta_data = {
+        "text": text,
+        "font": font.split("/")[-1].split(".")[0],
+        "contains_title": False,
+        "boxes": np.array(boxes, dtype=np.float64).reshape(-1, 4, 2),
+    }
     if fit:
-        return txt_img.crop(txt_img.getbbox()), txt_mask.crop(txt_img.getbbox())
+        bbox = txt_img.getbbox()
+        if bbox is not None:
+            meta_data["boxes"] -= bbox[:2]
+        return txt_img.crop(bbox), txt_mask.crop(bbox), meta_data
     else:
-        return txt_img, txt_mask
+        return txt_img, txt_mask, meta_data
 
 
 def _generate_vertical_text(
@@ -180,6 +361,7 @@ def _generate_vertical_text(
     fit: bool,
     stroke_width: int = 0,
     stroke_fill: str = "#282828",
+    rng: rnd.Random = rnd,
 ) -> Tuple:
     image_font = ImageFont.truetype(font=font, size=font_size)
 
@@ -202,21 +384,32 @@ def _generate_vertical_text(
     c1, c2 = colors[0], colors[-1]
 
     fill = (
-        rnd.randint(c1[0], c2[0]),
-        rnd.randint(c1[1], c2[1]),
-        rnd.randint(c1[2], c2[2]),
+        rng.randint(c1[0], c2[0]),
+        rng.randint(c1[1], c2[1]),
+        rng.randint(c1[2], c2[2]),
     )
 
     stroke_colors = [ImageColor.getrgb(c) for c in stroke_fill.split(",")]
     stroke_c1, stroke_c2 = stroke_colors[0], stroke_colors[-1]
 
     stroke_fill = (
-        rnd.randint(stroke_c1[0], stroke_c2[0]),
-        rnd.randint(stroke_c1[1], stroke_c2[1]),
-        rnd.randint(stroke_c1[2], stroke_c2[2]),
+        rng.randint(stroke_c1[0], stroke_c2[0]),
+        rng.randint(stroke_c1[1], stroke_c2[1]),
+        rng.randint(stroke_c1[2], stroke_c2[2]),
     )
 
+    boxes = []
     for i, c in enumerate(text):
+        boxes.append(
+            _piece_box(
+                image_font,
+                c,
+                0,
+                sum(char_heights[0:i]) + i * character_spacing,
+                stroke_width,
+                (text_width, char_heights[i]),
+            )
+        )
         txt_img_draw.text(
             (0, sum(char_heights[0:i]) + i * character_spacing),
             c,
@@ -234,10 +427,19 @@ def _generate_vertical_text(
             stroke_fill=stroke_fill,
         )
 
+    meta_data = {
+        "text": text,
+        "font": font.split("/")[-1].split(".")[0],
+        "contains_title": False,
+        "boxes": np.array(boxes, dtype=np.float64).reshape(-1, 4, 2),
+    }
     if fit:
-        return txt_img.crop(txt_img.getbbox()), txt_mask.crop(txt_img.getbbox())
+        bbox = txt_img.getbbox()
+        if bbox is not None:
+            meta_data["boxes"] -= bbox[:2]
+        return txt_img.crop(bbox), txt_mask.crop(bbox), meta_data
     else:
-        return txt_img, txt_mask
+        return txt_img, txt_mask, meta_data
 
 
 def get_text_width(font, text):
@@ -252,22 +454,47 @@ def wrap_text_by_pixels(text, font, max_width, max_lines):
     lines = []
     paragraphs = text.split('\n')
 
+    # Every distinct word is measured once, line widths are accumulated from
+    # the word advances and the advance of a space
+    space_advance = font.getlength(" ")
+    word_metrics = {}
+
     for paragraph in paragraphs:
         words = paragraph.split()
             
         current_line = ''
+        current_advance = 0
         
         for word in words:
             if len(lines) >= max_lines:
                 break
 
-            test_line = current_line + (" " if current_line else "") + word
-            w = get_text_width(font, test_line)
+            if word not in word_metrics:
+                word_metrics[word] = (font.getlength(word), get_text_width(font, word))
+            word_advance, word_width = word_metrics[word]
+
+            if current_line:
+                test_line = current_line + " " + word
+                w = current_advance + space_advance + word_width
+                # Kerning can move the end of the line by a few pixels, so
+                # the whole line is only measured when close to the limit
+                if abs(w - max_width) <= space_advance:
+                    w = get_text_width(font, test_line)
+                    test_advance = font.getlength(test_line)
+                else:
+                    test_advance = current_advance + space_advance + word_advance
+            else:
+                test_line = word
+                w = word_width
+                test_advance = word_advance
+
             if w <= max_width:
                 current_line = test_line
+                current_advance = test_advance
             else:
                 lines.append(current_line)
                 current_line = word
+                current_advance = word_advance
 
         if len(lines) < max_lines:
             lines.append(current_line)
@@ -275,15 +502,16 @@ def wrap_text_by_pixels(text, font, max_width, max_lines):
 
     return lines[:max_lines]
 
-def _load_font(font, font_size, max_retries=3):
+def _load_font(font, font_size, max_retries=3, rng=rnd):
     tries = 0
     while tries < max_retries:
         try:
             return ImageFont.truetype(font=font, size=font_size)
         except Exception as e:
             font_paths = ["./fonts/NotoSansArabic_Condensed-Regular.ttf","./fonts/Mada-Regular.ttf","./fonts/NotoSansArabic_SemiCondensed-Regular.ttf","./fonts/Fustat-Regular.ttf","./fonts/NotoSansArabic-Regular.ttf","./fonts/NotoNaskhArabic-Regular.ttf","./fonts/Vazirmatn-Regular.ttf","./fonts/IBMPlexSansArabic-Regular.ttf","./fonts/NotoKufiArabic-Regular.ttf","./fonts/Amiri-Regular.ttf","./fonts/NotoSansArabic_ExtraCondensed-Regular.ttf"]
-            font = rnd.choice(font_paths)
-            print(f"[Retry {tries+1}] Error with font '{font}': {e}")
+            counters.increment("font_fallback")
+            counters.log(f"[Retry {tries+1}] Error with font '{font}': {e}")
+            font = rng.choice(font_paths)
             tries += 1
 
 def _generate_paragraph_text(
@@ -297,16 +525,17 @@ def _generate_paragraph_text(
     stroke_width: int = 0,
     stroke_fill: str = "#282828",
     max_text_height: int = 1350,
-    max_lines: int = 11
+    max_lines: int = 11,
+    rng: rnd.Random = rnd,
 ) -> Tuple:
     contains_title = False
     flag = False
     # Load font
     if isinstance(font_size, list):
-        font_size = rnd.randint(font_size[0], font_size[1])
+        font_size = rng.randint(font_size[0], font_size[1])
 
     
-    image_font = _load_font(font, font_size)
+    image_font = _load_font(font, font_size, rng=rng)
     
     title = ''
     if isinstance(text, dict):
@@ -317,7 +546,7 @@ def _generate_paragraph_text(
     estimated_width = min(len(text) * font_size // 1.5, 1000)  # reasonable upper bound
     max_width = max(int(estimated_width), 200)
     
-    min_default_width = rnd.choice([800, 1000, 1500, 1600])
+    min_default_width = rng.choice([800, 1000, 1500, 1600])
     estimated_width = min(len(text) * font_size // 1.5, min_default_width)
     max_width = max(int(estimated_width), 800)
 
@@ -326,7 +555,7 @@ def _generate_paragraph_text(
     
     lines = wrap_text_by_pixels(text, image_font, max_width, max_lines)
     if title:
-        rnd_num = rnd.random()
+        rnd_num = rng.random()
         if rnd_num<0.5:
             lines.insert(0, '')
         else:
@@ -334,19 +563,18 @@ def _generate_paragraph_text(
         lines.insert(0, title)
         contains_title = True
     
-    # Recalculate text height
+    # Recalculate text height, the line metrics are measured once
     line_heights = [get_text_height(image_font, line) for line in lines]
-    character_spacing = rnd.randint(1,4)  # or your config value
+    line_widths = [get_text_width(image_font, line) for line in lines]
+    character_spacing = rng.randint(1,4)  # or your config value
     text_height = sum(line_heights) + (len(lines) - 1) * character_spacing
-    text_width = max([get_text_width(image_font, line) for line in lines])
     # Trim lines if total height is too big
     while text_height > max_text_height and len(lines) > 1:
         lines = lines[:-1]  # remove last line
-        line_heights = [get_text_height(image_font, line) for line in lines]
+        line_heights = line_heights[:-1]
+        line_widths = line_widths[:-1]
         text_height = sum(line_heights) + (len(lines) - 1) * character_spacing
-
-        
-        text_width = max([get_text_width(image_font, line) for line in lines])
+    text_width = max(line_widths)
 
     # Create images
     txt_img = Image.new("RGBA", (text_width, text_height), (0, 0, 0, 0))
@@ -360,23 +588,30 @@ def _generate_paragraph_text(
     colors = [ImageColor.getrgb(c) for c in text_color.split(",")]
     c1, c2 = colors[0], colors[-1]
     fill = (
-        rnd.randint(c1[0], c2[0]),
-        rnd.randint(c1[1], c2[1]),
-        rnd.randint(c1[2], c2[2]),
+        rng.randint(c1[0], c2[0]),
+        rng.randint(c1[1], c2[1]),
+        rng.randint(c1[2], c2[2]),
     )
 
     # Random stroke color within range
     stroke_colors = [ImageColor.getrgb(c) for c in stroke_fill.split(",")]
     stroke_c1, stroke_c2 = stroke_colors[0], stroke_colors[-1]
     stroke_fill = (
-        rnd.randint(stroke_c1[0], stroke_c2[0]),
-        rnd.randint(stroke_c1[1], stroke_c2[1]),
-        rnd.randint(stroke_c1[2], stroke_c2[2]),
+        rng.randint(stroke_c1[0], stroke_c2[0]),
+        rng.randint(stroke_c1[1], stroke_c2[1]),
+        rng.randint(stroke_c1[2], stroke_c2[2]),
     )
 
     # Draw text and mask
     current_y = 0
     original_image_font = image_font
+    layout = {
+        "lines": [],
+        "line_boxes": [],
+        "words": [],
+        "word_lines": [],
+        "word_boxes": [],
+    }
     for i, line in enumerate(lines): 
         if line=='':
             #last_added_y = get_text_height(image_font, 'اب') + character_spacing
@@ -389,10 +624,10 @@ def _generate_paragraph_text(
             image_font = ImageFont.truetype(font="./fonts/NotoSansMono-Light.ttf", size=font_size)
             flag = True
             
-        line_w = get_text_width(image_font, line)
+        line_w = line_widths[i] if line != "─" else get_text_width(image_font, line)
         x = text_width - line_w 
         if contains_title and i == 0:
-            rnd_num = rnd.random()
+            rnd_num = rng.random()
             if rnd_num<0.5:
                 x  = max(0, (text_width - line_w) // 2)  # center
         
@@ -422,6 +657,28 @@ def _generate_paragraph_text(
             stroke_width=stroke_width, 
             stroke_fill=stroke_fill, 
         ) 
+        if lines[i] != "─":
+            # Word and line boxes, straight from the layout
+            layout["lines"].append(line)
+            layout["line_boxes"].append(
+                _piece_box(image_font, line, x, current_y, stroke_width, (0, 0))
+            )
+            start = 0
+            for word in line.split(" "):
+                if word:
+                    layout["words"].append(word)
+                    layout["word_lines"].append(len(layout["lines"]) - 1)
+                    layout["word_boxes"].append(
+                        _piece_box(
+                            image_font,
+                            word,
+                            x + image_font.getlength(line[:start]),
+                            current_y,
+                            stroke_width,
+                            (0, 0),
+                        )
+                    )
+                start += len(word) + 1
         last_added_y = line_heights[i] + character_spacing
         current_y += last_added_y
         if flag:
@@ -433,12 +690,21 @@ def _generate_paragraph_text(
         "text": label,
         "font": font.split("/")[-1].split(".")[0],
         "contains_title": contains_title,
+        "layout": layout,
     }
+    layout["line_boxes"] = np.array(layout["line_boxes"], dtype=np.float64).reshape(
+        -1, 4, 2
+    )
+    layout["word_boxes"] = np.array(layout["word_boxes"], dtype=np.float64).reshape(
+        -1, 4, 2
+    )
     if fit:
         bbox = txt_img.getbbox()
         if bbox:  # In case bbox is None (completely transparent)
             txt_img = txt_img.crop(bbox)
             txt_mask = txt_mask.crop(bbox)
+            layout["line_boxes"] -= bbox[:2]
+            layout["word_boxes"] -= bbox[:2]
             
     return txt_img, txt_mask, meta_data
 
@@ -1,10 +1,26 @@
+import io
 import os
 import random as rnd
+from typing import List, Tuple
 
-from PIL import Image, ImageFilter, ImageStat
+import cv2
+import numpy as np
+from PIL import Image, ImageColor, ImageFilter, ImageStat
 
-from trdg import computer_text_generator, background_generator, distorsion_generator
-from trdg.utils import mask_to_bboxes, make_filename_valid
+from trdg import (
+    computer_text_generator,
+    background_generator,
+    distorsion_generator,
+    geometry_generator,
+)
+from trdg.utils import (
+    layout_to_annotations,
+    make_filename_valid,
+    mask_to_bboxes,
+    quads_to_bboxes,
+)
+from trdg.metrics import counters
+from trdg.profiling import timer
 
 try:
     from trdg import handwritten_text_generator
@@ -19,7 +35,7 @@ class FakeTextDataGenerator(object):
         Same as generate, but takes all parameters as one tuple
         """
 
-        cls.generate(*t)
+        return cls.generate(*t)
 
     @classmethod
     def generate(
@@ -55,244 +71,1027 @@ class FakeTextDataGenerator(object):
         image_mode: str = "RGB",
         output_bboxes: int = 0,
         blured_data_percetage: float = 0.2,
+        fused_geometry: bool = False,
+        direct_render: bool = False,
+        analytic_bboxes: bool = False,
+        output_annotations: bool = False,
+        line_crops: bool = False,
+        variants_per_render: int = 1,
+        pyramid_sizes: List[int] = None,
+        seed: int = None,
+        max_resamples: int = 0,
     ) -> Image:
         image = None
+
+        # Every call draws from its own generator, so that concurrent calls
+        # (thread backend) neither share state nor depend on each other
+        rng = rnd.Random(seed if seed is not None else rnd.getrandbits(64))
+
+        if pyramid_sizes and max(pyramid_sizes) > size:
+            raise ValueError("Pyramid sizes cannot be larger than the sample size")
         
         
-        margin_top, margin_left, margin_bottom, margin_right = rnd.choice(margins)
-        horizontal_margin = margin_left + margin_right
+        # Either one (top, left, bottom, right) tuple or a list to pick from
+        if isinstance(margins[0], int):
+            margins = [margins]
+        margin_top, margin_left, margin_bottom, margin_right = rng.choice(margins)
         vertical_margin = margin_top + margin_bottom
 
+        random_angle = rng.randint(0 - skewing_angle, skewing_angle)
+        angle = skewing_angle if not random_skew else random_angle
+        vertical = distorsion_orientation == 0 or distorsion_orientation == 2
+        horizontal = distorsion_orientation == 1 or distorsion_orientation == 2
+
+        ###########################################################
+        # Check the text color against the background beforehand #
+        ###########################################################
+        fill = text_color
+        images = None
+        if not is_handwritten and stroke_width == 0:
+            while True:
+                fill = computer_text_generator.pick_color(text_color, rng)
+                with timer.stage("precheck"):
+                    passes, images = cls._contrast_precheck(
+                        fill, background_type, image_dir
+                    )
+                if passes:
+                    break
+                counters.increment("low_contrast")
+                if max_resamples == 0:
+                    if variants_per_render == 1:
+                        return None
+                    return [None] * variants_per_render
+                counters.increment("resampled")
+                max_resamples -= 1
+
         ##########################
         # Create picture of text #
         ##########################
+        font_size = size
+        if direct_render and orientation == 0 and not is_handwritten:
+            # Render close to the final height so that resizing is only a
+            # small correction (for the first variant, the others are close)
+            with timer.stage("font_size"):
+                font_size = computer_text_generator.font_size_for_height(
+                    text,
+                    font,
+                    size,
+                    size - vertical_margin,
+                    angle,
+                    distorsion_type if vertical else 0,
+                    space_width,
+                    character_spacing,
+                    word_split,
+                    fit,
+                )
+
+        char_boxes = None
+        layout = None
         if is_handwritten:
             if orientation == 1:
                 raise ValueError("Vertical handwritten text is unavailable")
-            image, mask = handwritten_text_generator.generate(text, text_color)
+            with timer.stage("render"):
+                image, mask = handwritten_text_generator.generate(text, text_color, rng)
+            meta_data = {"text": text, "font": None, "contains_title": False}
         else:
-            image, mask, meta_data = computer_text_generator.generate(
+            with timer.stage("render"):
+                image, mask, meta_data = computer_text_generator.generate(
+                    text,
+                    font,
+                    fill,
+                    font_size,
+                    orientation,
+                    space_width,
+                    character_spacing,
+                    fit,
+                    word_split,
+                    stroke_width,
+                    stroke_fill,
+                    rng,
+                )
+            char_boxes = meta_data.pop("boxes", None)
+            layout = meta_data.pop("layout", None)
+
+        # Everything below only depends on the text render, so that it can be
+        # run several times with different random parameters
+        def augment(index: int, meta_data: dict, margin: Tuple, angle: int):
+            margin_top, margin_left, margin_bottom, margin_right = margin
+            horizontal_margin = margin_left + margin_right
+            vertical_margin = margin_top + margin_bottom
+
+            def target_size(distorted_width: int, distorted_height: int) -> Tuple:
+                # Horizontal text
+                if orientation == 0:
+                    new_width = int(
+                        distorted_width
+                        * (float(size - vertical_margin) / float(distorted_height))
+                    )
+                    return new_width, size - vertical_margin
+                # Vertical text
+                elif orientation == 1:
+                    new_height = int(
+                        float(distorted_height)
+                        * (float(size - horizontal_margin) / float(distorted_width))
+                    )
+                    return size - horizontal_margin, new_height
+                # For paragraph, we keep the distorted_img and mask as-is (no resize)
+                elif orientation == 2:
+                    return distorted_width, distorted_height
+                else:
+                    raise ValueError("Invalid orientation")
+
+            # The distortion offsets are drawn once, so that the text boxes can
+            # follow the exact same transform as the pixels
+            _, rotated_size = geometry_generator.rotation_matrix(image.size, angle)
+            with timer.stage("distort_field"):
+                field = geometry_generator.distorsion_field(
+                    distorsion_type, rotated_size, vertical, horizontal, rng
+                )
+
+            resized_img, resized_mask = cls._transform(
+                image,
+                mask,
+                angle,
+                distorsion_type,
+                vertical,
+                horizontal,
+                target_size,
+                field,
+                fused_geometry,
+            )
+
+            # Horizontal text
+            if orientation == 0:
+                background_width = (
+                    width if width > 0 else resized_img.size[0] + horizontal_margin
+                )
+                background_height = size
+            # Vertical text
+            elif orientation == 1:
+                background_width = size
+                background_height = resized_img.size[1] + vertical_margin
+            # Paragraph, background size same as the image size + margins
+            else:
+                background_width = resized_img.size[0] + horizontal_margin
+                background_height = resized_img.size[1] + vertical_margin
+
+            #############################
+            # Generate background image #
+            #############################
+            with timer.stage("background"):
+                background_img = cls._background(
+                    background_type,
+                    background_height,
+                    background_width,
+                    image_dir,
+                    rng,
+                    images,
+                )
+            background_mask = Image.new(
+                "RGB", (background_width, background_height), (0, 0, 0)
+            )
+
+            ##############################################################
+            # Comparing average pixel value of text and background image #
+            ##############################################################
+            try:
+                with timer.stage("contrast"):
+                    low_contrast = cls._low_contrast(
+                        resized_img, resized_mask, background_img
+                    )
+                if low_contrast:
+                    return
+            except Exception as err:
+                counters.increment("error")
+                counters.log(f"Error during image contrast check: {err}")
+                return
+
+
+            #############################
+            # Place text with alignment #
+            #############################
+
+            new_text_width, _ = resized_img.size
+
+            if alignment == 0 or width == -1:
+                text_x = margin_left
+            elif alignment == 1:
+                text_x = int(background_width / 2 - new_text_width / 2)
+            else:
+                text_x = background_width - new_text_width - margin_right
+
+            with timer.stage("paste"):
+                background_img.paste(resized_img, (text_x, margin_top), resized_img)
+                background_mask.paste(resized_mask, (text_x, margin_top))
+
+            ############################################################
+            # Follow the text boxes from the layout through the chain #
+            ############################################################
+            quads = None
+            if char_boxes is not None and (
+                output_bboxes == 3 or (output_bboxes in (1, 2) and analytic_bboxes)
+            ):
+                quads = geometry_generator.transform_points(
+                    char_boxes, image.size, angle, field, resized_img.size
+                ) + (text_x, margin_top)
+            elif output_bboxes == 3:
+                raise ValueError("Quadrilateral bounding boxes need computer text")
+
+            annotations = None
+            line_quads = None
+            if (output_annotations or line_crops) and layout is not None:
+                line_quads, word_quads = (
+                    geometry_generator.transform_points(
+                        boxes, image.size, angle, field, resized_img.size
+                    )
+                    + (text_x, margin_top)
+                    for boxes in (layout["line_boxes"], layout["word_boxes"])
+                )
+            if output_annotations and layout is not None:
+                annotations = {
+                    "lines": layout_to_annotations(
+                        layout["lines"],
+                        line_quads,
+                        layout["words"],
+                        word_quads,
+                        layout["word_lines"],
+                        background_img.size,
+                    )
+                }
+
+            ############################################
+            # Change image mode (RGB, grayscale, etc.) #
+            ############################################
+
+            with timer.stage("convert"):
+                background_img = background_img.convert(image_mode)
+                background_mask = background_mask.convert(image_mode)
+
+            #######################
+            # Apply gaussian blur #
+            #######################
+            radius = blur
+            if not rng.random() < blured_data_percetage:
+                radius = 0
+
+            gaussian_filter = ImageFilter.GaussianBlur(
+                radius=radius if not random_blur else rng.random() * radius
+            )
+            with timer.stage("blur"):
+                final_image = background_img.filter(gaussian_filter)
+                final_mask = background_mask.filter(gaussian_filter)
+
+            #####################################
+            # Generate name for resulting image #
+            #####################################
+            # We remove spaces if space_width == 0
+            label = text.replace(" ", "") if space_width == 0 else text
+            with timer.stage("name"):
+                name = cls._name(label, index, name_format)
+            image_name = "{}.{}".format(name, extension)
+            mask_name = "{}_mask.png".format(name)
+            box_name = "{}_boxes.txt".format(name)
+            tess_box_name = "{}.box".format(name)
+
+            if annotations is not None:
+                annotations["image"] = image_name
+                meta_data["annotations"] = annotations
+
+            ###############################################
+            # Cut every line out of the composed paragraph #
+            ###############################################
+            crops = []
+            if line_crops and line_quads is not None:
+                for i, (line, bbox) in enumerate(
+                    zip(layout["lines"], quads_to_bboxes(line_quads, final_image.size))
+                ):
+                    crops.append(
+                        (
+                            "{}_{}.{}".format(name, i, extension),
+                            final_image.crop((bbox[0], bbox[1], bbox[2] + 1, bbox[3] + 1)),
+                            line,
+                        )
+                    )
+
+            # Save the image
+            if out_dir is not None:
+                levels = [(out_dir, final_image, final_mask, quads)]
+                if pyramid_sizes:
+                    # One output tree per height, all cut from the same sample
+                    levels = [
+                        (os.path.join(out_dir, str(height)),)
+                        + cls._downscale(final_image, final_mask, quads, height / size)
+                        for height in pyramid_sizes
+                    ]
+                for level_dir, level_image, level_mask, level_quads in levels:
+                    cls._save(level_image, os.path.join(level_dir, image_name))
+                    if output_mask == 1:
+                        cls._save(level_mask, os.path.join(level_dir, mask_name))
+                    if output_bboxes == 1:
+                        if level_quads is not None:
+                            bboxes = quads_to_bboxes(level_quads, level_image.size)
+                        else:
+                            bboxes = mask_to_bboxes(level_mask)
+                        with open(os.path.join(level_dir, box_name), "w") as f:
+                            for bbox in bboxes:
+                                f.write(" ".join([str(v) for v in bbox]) + "\n")
+                    if output_bboxes == 2:
+                        if level_quads is not None:
+                            bboxes = quads_to_bboxes(
+                                level_quads, level_image.size, tess=True
+                            )
+                        else:
+                            bboxes = mask_to_bboxes(level_mask, tess=True)
+                        with open(os.path.join(level_dir, tess_box_name), "w") as f:
+                            for bbox, char in zip(bboxes, label):
+                                f.write(
+                                    " ".join([char] + [str(v) for v in bbox] + ["0"])
+                                    + "\n"
+                                )
+                    if output_bboxes == 3:
+                        with open(os.path.join(level_dir, box_name), "w") as f:
+                            for quad in np.rint(level_quads).astype(int):
+                                f.write(
+                                    " ".join([str(v) for v in quad.flatten()]) + "\n"
+                                )
+                counters.increment("written")
+                if crops:
+                    for crop_name, crop, _ in crops:
+                        cls._save(crop, os.path.join(out_dir, crop_name))
+                    meta_data["line_crops"] = [
+                        (crop_name, label) for crop_name, _, label in crops
+                    ]
+                meta_data["index"] = index
+                meta_data["name"] = image_name
+
+                return meta_data
+            else:
+                if output_mask == 1:
+                    raise Exception("output mask = 1")
+
+                if crops:
+                    meta_data["line_crops"] = [(crop, label) for _, crop, label in crops]
+
+                if quads is not None:
+                    meta_data["bboxes"] = (
+                        np.rint(quads).astype(int).tolist()
+                        if output_bboxes == 3
+                        else quads_to_bboxes(
+                            quads, final_image.size, tess=output_bboxes == 2
+                        )
+                    )
+
+                if pyramid_sizes:
+                    meta_data["pyramid"] = {}
+                    for height in pyramid_sizes:
+                        level_image, _, level_quads = cls._downscale(
+                            final_image, final_mask, quads, height / size
+                        )
+                        meta_data["pyramid"][height] = level_image
+                        if level_quads is not None:
+                            meta_data.setdefault("pyramid_bboxes", {})[height] = (
+                                np.rint(level_quads).astype(int).tolist()
+                                if output_bboxes == 3
+                                else quads_to_bboxes(
+                                    level_quads,
+                                    level_image.size,
+                                    tess=output_bboxes == 2,
+                                )
+                            )
+                
+                return final_image, meta_data
+
+        ###################################################
+        # Feed the same text render to every augmentation #
+        ###################################################
+        results = [
+            augment(
+                index,
+                meta_data,
+                (margin_top, margin_left, margin_bottom, margin_right),
+                angle,
+            )
+        ]
+        for i in range(1, variants_per_render):
+            random_angle = rng.randint(0 - skewing_angle, skewing_angle)
+            results.append(
+                augment(
+                    index + i,
+                    dict(meta_data),
+                    rng.choice(margins),
+                    skewing_angle if not random_skew else random_angle,
+                )
+            )
+
+        # Samples rejected by the contrast check are generated again from the
+        # same text and font, with all the other random parameters (text
+        # color, background, skew, margins...) drawn again
+        for i in range(len(results)):
+            if results[i] is None and max_resamples > 0:
+                counters.increment("resampled")
+                results[i] = cls.generate(
+                    index + i,
+                    text,
+                    font,
+                    out_dir,
+                    size,
+                    extension,
+                    skewing_angle,
+                    random_skew,
+                    blur,
+                    random_blur,
+                    background_type,
+                    distorsion_type,
+                    distorsion_orientation,
+                    is_handwritten,
+                    name_format,
+                    width,
+                    alignment,
+                    text_color,
+                    orientation,
+                    space_width,
+                    character_spacing,
+                    margins,
+                    fit,
+                    output_mask,
+                    word_split,
+                    image_dir,
+                    stroke_width,
+                    stroke_fill,
+                    image_mode,
+                    output_bboxes,
+                    blured_data_percetage,
+                    fused_geometry,
+                    direct_render,
+                    analytic_bboxes,
+                    output_annotations,
+                    line_crops,
+                    pyramid_sizes=pyramid_sizes,
+                    seed=rng.getrandbits(64),
+                    max_resamples=max_resamples - 1,
+                )
+
+        if variants_per_render == 1:
+            return results[0]
+        return results
+
+    @classmethod
+    def generate_page_from_tuple(cls, t):
+        """
+        Same as generate_page, but takes all parameters as one tuple
+        """
+
+        return cls.generate_page(*t)
+
+    @classmethod
+    def generate_page(
+        cls,
+        index: int,
+        texts: List[str],
+        fonts: List[str],
+        out_dir: str,
+        size: int,
+        extension: str,
+        skewing_angle: int,
+        random_skew: bool,
+        blur: int,
+        random_blur: bool,
+        background_type: int,
+        distorsion_type: int,
+        distorsion_orientation: int,
+        name_format: int,
+        page_width: int,
+        text_color: str,
+        space_width: int,
+        character_spacing: int,
+        margins: int,
+        fit: bool,
+        word_split: bool,
+        image_dir: str,
+        stroke_width: int = 0,
+        stroke_fill: str = "#282828",
+        image_mode: str = "RGB",
+        blured_data_percetage: float = 0.2,
+        fused_geometry: bool = False,
+        direct_render: bool = False,
+        seed: int = None,
+    ) -> List:
+        """
+        Generate one horizontal line sample per text, like generate, but
+        compose all of them on a single page so that the background and the
+        blur are computed once. Each line is skewed and distorted on its own,
+        then cut back out of the page with its margins. The i-th text gets
+        the index index + i, lines with a too low contrast are dropped.
+        """
+
+        rng = rnd.Random(seed if seed is not None else rnd.getrandbits(64))
+
+        if isinstance(margins[0], int):
+            margins = [margins]
+
+        ########################################
+        # Render and transform every text line #
+        ########################################
+        lines = []
+        for i, (text, font) in enumerate(zip(texts, fonts)):
+            margin_top, margin_left, margin_bottom, margin_right = rng.choice(margins)
+            meta_data, resized_img, resized_mask = cls._render_line(
                 text,
                 font,
-                text_color,
                 size,
-                orientation,
+                margin_top + margin_bottom,
+                skewing_angle,
+                random_skew,
+                distorsion_type,
+                distorsion_orientation,
+                text_color,
                 space_width,
                 character_spacing,
                 fit,
                 word_split,
                 stroke_width,
                 stroke_fill,
+                fused_geometry,
+                direct_render,
+                rng,
+            )
+            lines.append(
+                (
+                    index + i,
+                    text,
+                    meta_data,
+                    resized_img,
+                    resized_mask,
+                    (margin_top, margin_left),
+                    resized_img.size[0] + margin_left + margin_right,
+                )
             )
-        random_angle = rnd.randint(0 - skewing_angle, skewing_angle)
 
-        rotated_img = image.rotate(
-            skewing_angle if not random_skew else random_angle, expand=1
-        )
+        ###################################
+        # Pack the lines in rows of cells #
+        ###################################
+        page_width = max([page_width] + [line[-1] for line in lines])
+        cells = []
+        x, y = 0, 0
+        for line in lines:
+            if x + line[-1] > page_width:
+                x, y = 0, y + size
+            cells.append((x, y))
+            x += line[-1]
+        page_height = y + size
+
+        ######################################
+        # Compose the page with a background #
+        ######################################
+        with timer.stage("background"):
+            page_img = cls._background(
+                background_type, page_height, page_width, image_dir, rng
+            )
+        kept = []
+        for line, (x, y) in zip(lines, cells):
+            _, _, _, resized_img, resized_mask, offset, cell_width = line
+            try:
+                with timer.stage("contrast"):
+                    low_contrast = cls._low_contrast(
+                        resized_img,
+                        resized_mask,
+                        page_img.crop((x, y, x + cell_width, y + size)),
+                    )
+                if low_contrast:
+                    continue
+            except Exception as err:
+                counters.increment("error")
+                counters.log(f"Error during image contrast check: {err}")
+                continue
+            with timer.stage("paste"):
+                page_img.paste(resized_img, (x + offset[1], y + offset[0]), resized_img)
+            kept.append((line, (x, y)))
+
+        with timer.stage("convert"):
+            page_img = page_img.convert(image_mode)
 
-        rotated_mask = mask.rotate(
-            skewing_angle if not random_skew else random_angle, expand=1
+        if not rng.random() < blured_data_percetage:
+            blur = 0
+
+        gaussian_filter = ImageFilter.GaussianBlur(
+            radius=blur if not random_blur else rng.random() * blur
         )
+        with timer.stage("blur"):
+            page_img = page_img.filter(gaussian_filter)
 
-        #############################
-        # Apply distortion to image #
-        #############################
-        if distorsion_type == 0:
-            distorted_img = rotated_img  # Mind = blown
-            distorted_mask = rotated_mask
-        elif distorsion_type == 1:
-            distorted_img, distorted_mask = distorsion_generator.sin(
-                rotated_img,
-                rotated_mask,
-                vertical=(distorsion_orientation == 0 or distorsion_orientation == 2),
-                horizontal=(distorsion_orientation == 1 or distorsion_orientation == 2),
-            )
-        elif distorsion_type == 2:
-            distorted_img, distorted_mask = distorsion_generator.cos(
-                rotated_img,
-                rotated_mask,
-                vertical=(distorsion_orientation == 0 or distorsion_orientation == 2),
-                horizontal=(distorsion_orientation == 1 or distorsion_orientation == 2),
-            )
-        else:
-            distorted_img, distorted_mask = distorsion_generator.random(
-                rotated_img,
-                rotated_mask,
-                vertical=(distorsion_orientation == 0 or distorsion_orientation == 2),
-                horizontal=(distorsion_orientation == 1 or distorsion_orientation == 2),
-            )
+        ##########################
+        # Cut the lines back out #
+        ##########################
+        results = []
+        for (line_index, text, meta_data, _, _, _, cell_width), (x, y) in kept:
+            final_image = page_img.crop((x, y, x + cell_width, y + size))
+            if out_dir is not None:
+                if space_width == 0:
+                    text = text.replace(" ", "")
+                with timer.stage("name"):
+                    name = cls._name(text, line_index, name_format)
+                image_name = "{}.{}".format(name, extension)
+                cls._save(final_image, os.path.join(out_dir, image_name))
+                counters.increment("written")
+                meta_data["index"] = line_index
+                meta_data["name"] = image_name
+                results.append(meta_data)
+            else:
+                results.append((final_image, meta_data))
 
-        ##################################
-        # Resize image to desired format #
-        ##################################
+        return results
 
-        # Horizontal text
-        if orientation == 0:
-            new_width = int(
-                distorted_img.size[0]
-                * (float(size - vertical_margin) / float(distorted_img.size[1]))
-            )
-            resized_img = distorted_img.resize(
-                (new_width, size - vertical_margin), Image.Resampling.LANCZOS
-            )
-            resized_mask = distorted_mask.resize(
-                (new_width, size - vertical_margin), Image.Resampling.NEAREST
-            )
-            background_width = width if width > 0 else new_width + horizontal_margin
-            background_height = size
-        # Vertical text
-        elif orientation == 1:
-            new_height = int(
-                float(distorted_img.size[1])
-                * (float(size - horizontal_margin) / float(distorted_img.size[0]))
-            )
-            resized_img = distorted_img.resize(
-                (size - horizontal_margin, new_height), Image.Resampling.LANCZOS
+    @classmethod
+    def generate_batch(
+        cls,
+        texts: List[str],
+        fonts: List[str],
+        size: int,
+        skewing_angle: int,
+        random_skew: bool,
+        blur: int,
+        random_blur: bool,
+        background_type: int,
+        distorsion_type: int,
+        distorsion_orientation: int,
+        text_color: str,
+        space_width: int,
+        character_spacing: int,
+        margins: int,
+        fit: bool,
+        word_split: bool,
+        image_dir: str,
+        stroke_width: int = 0,
+        stroke_fill: str = "#282828",
+        image_mode: str = "RGB",
+        blured_data_percetage: float = 0.2,
+        fused_geometry: bool = False,
+        direct_render: bool = False,
+        seed: int = None,
+    ) -> Tuple:
+        """
+        Generate one horizontal text sample per text and return them stacked
+        in a (N, size, W, C) uint8 array, padded with zeros on the right up to
+        the widest sample, along with the widths of the samples and their
+        labels. Backgrounds, composition, mode conversion and blur are applied
+        to the stacked arrays. Samples with a too low contrast are dropped.
+        """
+
+        if image_mode not in ("RGB", "L"):
+            raise ValueError("Batches can only be generated in RGB or L mode")
+
+        rng = rnd.Random(seed if seed is not None else rnd.getrandbits(64))
+        if isinstance(margins[0], int):
+            margins = [margins]
+
+        ########################################
+        # Render and transform every text line #
+        ########################################
+        lines = []
+        for text, font in zip(texts, fonts):
+            margin_top, margin_left, margin_bottom, margin_right = rng.choice(margins)
+            _, resized_img, resized_mask = cls._render_line(
+                text,
+                font,
+                size,
+                margin_top + margin_bottom,
+                skewing_angle,
+                random_skew,
+                distorsion_type,
+                distorsion_orientation,
+                text_color,
+                space_width,
+                character_spacing,
+                fit,
+                word_split,
+                stroke_width,
+                stroke_fill,
+                fused_geometry,
+                direct_render,
+                rng,
             )
-            resized_mask = distorted_mask.resize(
-                (size - horizontal_margin, new_height), Image.Resampling.NEAREST
+            lines.append(
+                (
+                    text,
+                    resized_img,
+                    resized_mask,
+                    (margin_top, margin_left),
+                    resized_img.size[0] + margin_left + margin_right,
+                )
             )
-            background_width = size
-            background_height = new_height + vertical_margin
-        elif orientation == 2:
-            # For paragraph, we keep the distorted_img and mask as-is (no resize)
-            resized_img = distorted_img
-            resized_mask = distorted_mask
-
-            # Set background size same as the image size + margins
-            background_width = distorted_img.size[0] + horizontal_margin
-            background_height = distorted_img.size[1] + vertical_margin
-        else:
-            raise ValueError("Invalid orientation")
+
+        count = len(lines)
+        widths = np.array([line[-1] for line in lines], dtype=np.int64)
+        batch_width = int(widths.max()) if count > 0 else 0
 
         #############################
-        # Generate background image #
+        # Generate background batch #
         #############################
-        if background_type == 0:
-            background_img = background_generator.gaussian_noise(
-                background_height, background_width
-            )
-        elif background_type == 1:
-            background_img = background_generator.plain_white(
-                background_height, background_width
-            )
-        elif background_type == 2:
-            background_img = background_generator.quasicrystal(
-                background_height, background_width
-            )
-        elif background_type == 3:
-            rand_num = rnd.random()  # Random float between 0 and 1
-            if rand_num > 0.3:
-                background_img = background_generator.plain_white(
-                    background_height, background_width
+        if background_type in (0, 1, 3):
+            backgrounds = np.full((count, size, batch_width), 255, dtype=np.uint8)
+            if background_type == 0:
+                backgrounds = background_generator.gaussian_noise_batch(
+                    count, size, batch_width, rng
                 )
-            else:
-                background_img = background_generator.gaussian_noise(
-                    background_height, background_width
+            elif background_type == 3:
+                # Same 70% plain white, 30% gaussian noise split as generate
+                noisy = np.array([rng.random() <= 0.3 for _ in range(count)], bool)
+                backgrounds[noisy] = background_generator.gaussian_noise_batch(
+                    int(noisy.sum()), size, batch_width, rng
                 )
+            backgrounds = np.repeat(backgrounds[..., None], 3, axis=3)
         else:
-            background_img = background_generator.image(
-                background_height, background_width, image_dir
-            )
-        background_mask = Image.new(
-            "RGB", (background_width, background_height), (0, 0, 0)
-        )
+            backgrounds = np.zeros((count, size, batch_width, 3), dtype=np.uint8)
+            for i, width in enumerate(widths):
+                backgrounds[i, :, :width] = np.asarray(
+                    cls._background(
+                        background_type, size, int(width), image_dir, rng
+                    )
+                    .convert("RGB")
+                )
 
         ##############################################################
         # Comparing average pixel value of text and background image #
         ##############################################################
-        try:
-            '''print("resized_img:")
-            print("  mode:", resized_img.mode)
-            print("  size:", resized_img.size)
-
-            print("resized_mask:")
-            print("  mode:", resized_mask.mode)
-            print("  size:", resized_mask.size)
-
-            # Get the 3rd channel (alpha if RGBA)
+        kept = []
+        for i, (_, resized_img, resized_mask, _, width) in enumerate(lines):
             try:
-                mask_channel = resized_mask.split()[2]
-                print("resized_mask.split()[2]:")
-                print("  mode:", mask_channel.mode)
-                print("  size:", mask_channel.size)
-            except Exception as e:
-                print("Error accessing resized_mask.split()[2]:", e)'''
+                if not cls._low_contrast(
+                    resized_img,
+                    resized_mask,
+                    Image.fromarray(backgrounds[i, :, :width]).convert("RGBA"),
+                ):
+                    kept.append(i)
+            except Exception as err:
+                counters.increment("error")
+                counters.log(f"Error during image contrast check: {err}")
+        lines = [lines[i] for i in kept]
+        widths = widths[kept]
+        backgrounds = backgrounds[kept]
+        batch_width = int(widths.max()) if len(kept) > 0 else 0
+        backgrounds = backgrounds[:, :, :batch_width]
 
-            resized_img_st = ImageStat.Stat(resized_img, resized_mask.split()[2])
-            background_img_st = ImageStat.Stat(background_img)
+        ##################################################
+        # Place the text and blend the batch in one pass #
+        ##################################################
+        texts_layer = np.zeros(backgrounds.shape[:3] + (4,), dtype=np.uint8)
+        for i, (_, resized_img, _, (margin_top, margin_left), _) in enumerate(lines):
+            texts_layer[
+                i,
+                margin_top : margin_top + resized_img.size[1],
+                margin_left : margin_left + resized_img.size[0],
+            ] = np.asarray(resized_img.convert("RGBA"))
+        alpha = texts_layer[..., 3:].astype(np.float32) / 255
+        images = np.rint(
+            backgrounds * (1 - alpha) + texts_layer[..., :3] * alpha
+        ).astype(np.uint8)
 
-            resized_img_px_mean = sum(resized_img_st.mean[:2]) / 3
-            background_img_px_mean = sum(background_img_st.mean) / 3
+        ############################################
+        # Change image mode (RGB, grayscale, etc.) #
+        ############################################
+        if image_mode == "L":
+            # Same ITU-R 601-2 luma transform as Image.convert("L")
+            images = (
+                (
+                    images[..., 0].astype(np.uint32) * 19595
+                    + images[..., 1].astype(np.uint32) * 38470
+                    + images[..., 2].astype(np.uint32) * 7471
+                    + 0x8000
+                )
+                >> 16
+            ).astype(np.uint8)[..., None]
 
-            if abs(resized_img_px_mean - background_img_px_mean) < 15:
-                print("value of mean pixel is too similar. Ignore this image")
+        #######################
+        # Apply gaussian blur #
+        #######################
+        for i, width in enumerate(widths):
+            radius = blur
+            if not rng.random() < blured_data_percetage:
+                radius = 0
+            radius = radius if not random_blur else rng.random() * radius
+            if radius > 0:
+                images[i, :, :width] = cv2.GaussianBlur(
+                    images[i, :, :width], (0, 0), radius
+                ).reshape(images[i, :, :width].shape)
 
-                print("resized_img_st \n {}".format(resized_img_st.mean))
-                print("background_img_st \n {}".format(background_img_st.mean))
+        # Padding stays black whatever the background
+        images *= (np.arange(batch_width)[None, :] < widths[:, None])[
+            :, None, :, None
+        ].astype(np.uint8)
 
-                return
-        except Exception as err:
-            print(f"Error during image contrast check: {err}")
-            return
+        return images, widths, [line[0] for line in lines]
 
+    @classmethod
+    def _render_line(
+        cls,
+        text: str,
+        font: str,
+        size: int,
+        vertical_margin: int,
+        skewing_angle: int,
+        random_skew: bool,
+        distorsion_type: int,
+        distorsion_orientation: int,
+        text_color: str,
+        space_width: int,
+        character_spacing: int,
+        fit: bool,
+        word_split: bool,
+        stroke_width: int,
+        stroke_fill: str,
+        fused_geometry: bool,
+        direct_render: bool,
+        rng: rnd.Random,
+    ) -> Tuple:
+        """
+        Render a horizontal text line, skew and distort it with random
+        parameters and resize it to fit size once the margins are added
+        """
 
-        #############################
-        # Place text with alignment #
-        #############################
+        height = size - vertical_margin
 
-        new_text_width, _ = resized_img.size
+        vertical = distorsion_orientation == 0 or distorsion_orientation == 2
+        horizontal = distorsion_orientation == 1 or distorsion_orientation == 2
+        angle = (
+            skewing_angle
+            if not random_skew
+            else rng.randint(0 - skewing_angle, skewing_angle)
+        )
 
-        if alignment == 0 or width == -1:
-            background_img.paste(resized_img, (margin_left, margin_top), resized_img)
-            background_mask.paste(resized_mask, (margin_left, margin_top))
-        elif alignment == 1:
-            background_img.paste(
-                resized_img,
-                (int(background_width / 2 - new_text_width / 2), margin_top),
-                resized_img,
+        font_size = size
+        if direct_render:
+            with timer.stage("font_size"):
+                font_size = computer_text_generator.font_size_for_height(
+                    text,
+                    font,
+                    size,
+                    height,
+                    angle,
+                    distorsion_type if vertical else 0,
+                    space_width,
+                    character_spacing,
+                    word_split,
+                    fit,
+                )
+        with timer.stage("render"):
+            image, mask, meta_data = computer_text_generator.generate(
+                text,
+                font,
+                text_color,
+                font_size,
+                0,
+                space_width,
+                character_spacing,
+                fit,
+                word_split,
+                stroke_width,
+                stroke_fill,
+                rng,
             )
-            background_mask.paste(
-                resized_mask,
-                (int(background_width / 2 - new_text_width / 2), margin_top),
+        meta_data.pop("boxes", None)
+
+        _, rotated_size = geometry_generator.rotation_matrix(image.size, angle)
+        with timer.stage("distort_field"):
+            field = geometry_generator.distorsion_field(
+                distorsion_type, rotated_size, vertical, horizontal, rng
             )
-        else:
-            background_img.paste(
-                resized_img,
-                (background_width - new_text_width - margin_right, margin_top),
-                resized_img,
+        resized_img, resized_mask = cls._transform(
+            image,
+            mask,
+            angle,
+            distorsion_type,
+            vertical,
+            horizontal,
+            lambda w, h: (int(w * (float(height) / float(h))), height),
+            field,
+            fused_geometry,
+        )
+
+        return meta_data, resized_img, resized_mask
+
+    @classmethod
+    def _transform(
+        cls,
+        image: Image,
+        mask: Image,
+        angle: float,
+        distorsion_type: int,
+        vertical: bool,
+        horizontal: bool,
+        target_size,
+        field: Tuple,
+        fused_geometry: bool,
+    ) -> Tuple:
+        """
+        Skew, distort (with the offsets of field) and resize the text image
+        and its mask to the size returned by target_size
+        """
+
+        if fused_geometry:
+            ###########################################################
+            # Rotate, distort and resize in a single coordinate remap #
+            ###########################################################
+            with timer.stage("geometry"):
+                return geometry_generator.fused_transform(
+                    image,
+                    mask,
+                    angle,
+                    distorsion_type,
+                    vertical,
+                    horizontal,
+                    target_size,
+                    field,
+                )
+
+        with timer.stage("rotate"):
+            rotated_img = image.rotate(angle, expand=1)
+
+            rotated_mask = mask.rotate(angle, expand=1)
+
+        #############################
+        # Apply distortion to image #
+        #############################
+        max_offset, vertical_offsets, horizontal_offsets, _ = field
+        with timer.stage("distort"):
+            distorted_img, distorted_mask = distorsion_generator.apply_offsets(
+                rotated_img,
+                rotated_mask,
+                vertical_offsets is not None,
+                horizontal_offsets is not None,
+                max_offset,
+                vertical_offsets,
+                horizontal_offsets,
             )
-            background_mask.paste(
-                resized_mask,
-                (background_width - new_text_width - margin_right, margin_top),
+
+        ##################################
+        # Resize image to desired format #
+        ##################################
+        new_size = target_size(*distorted_img.size)
+
+        if new_size == distorted_img.size:
+            return distorted_img, distorted_mask
+        with timer.stage("resize"):
+            return (
+                distorted_img.resize(new_size, Image.Resampling.LANCZOS),
+                distorted_mask.resize(new_size, Image.Resampling.NEAREST),
             )
 
-        ############################################
-        # Change image mode (RGB, grayscale, etc.) #
-        ############################################
+    @classmethod
+    def _save(cls, image: Image, path: str):
+        """
+        Save an image, encoding and writing it as two separate stages when
+        the stage timer is enabled
+        """
 
-        background_img = background_img.convert(image_mode)
-        background_mask = background_mask.convert(image_mode)
+        if not timer.enabled:
+            image.save(path)
+            return
 
-        #######################
-        # Apply gaussian blur #
-        #######################
-        
-        if not rnd.random() < blured_data_percetage:
-            blur = 0
-                
-        gaussian_filter = ImageFilter.GaussianBlur(
-            radius=blur if not random_blur else rnd.random() * blur
+        # Same lookup as Image.save, which only loads every plugin if needed
+        extension = os.path.splitext(path)[1].lower()
+        Image.preinit()
+        image_format = Image.EXTENSION.get(extension)
+        if image_format is None:
+            image_format = Image.registered_extensions().get(extension)
+        if image_format is None:
+            image.save(path)
+            return
+
+        with timer.stage("encode"):
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format)
+        with timer.stage("write"):
+            with open(path, "wb") as f:
+                f.write(buffer.getbuffer())
+
+    @classmethod
+    def _downscale(cls, image: Image, mask: Image, quads, scale: float) -> Tuple:
+        """
+        Downscale a sample, its mask and its text boxes by scale (<= 1),
+        averaging the image pixels over the area they cover
+        """
+
+        if scale == 1:
+            return image, mask, quads
+
+        new_size = (
+            max(int(round(image.size[0] * scale)), 1),
+            max(int(round(image.size[1] * scale)), 1),
+        )
+        return (
+            image.resize(new_size, Image.Resampling.BOX),
+            mask.resize(new_size, Image.Resampling.NEAREST),
+            None
+            if quads is None
+            else quads * (new_size[0] / image.size[0], new_size[1] / image.size[1]),
         )
-        final_image = background_img.filter(gaussian_filter)
-        final_mask = background_mask.filter(gaussian_filter)
-
-        #####################################
-        # Generate name for resulting image #
-        #####################################
-        # We remove spaces if space_width == 0
-        if space_width == 0:
-            text = text.replace(" ", "")
+
+    @classmethod
+    def _name(cls, text: str, index: int, name_format: int) -> str:
+        """
+        Build the file name (without extension) of a sample
+        """
+
         if name_format == 0:
             name = "{}_{}".format(text, str(index))
         elif name_format == 1:
@@ -303,33 +1102,115 @@ class FakeTextDataGenerator(object):
             print("{} is not a valid name format. Using default.".format(name_format))
             name = "{}_{}".format(text, str(index))
 
-        name = make_filename_valid(name, allow_unicode=True)
-        image_name = "{}.{}".format(name, extension)
-        mask_name = "{}_mask.png".format(name)
-        box_name = "{}_boxes.txt".format(name)
-        tess_box_name = "{}.box".format(name)
-
-        # Save the image
-        if out_dir is not None:
-            final_image.save(os.path.join(out_dir, image_name))
-            if output_mask == 1:
-                final_mask.save(os.path.join(out_dir, mask_name))
-            if output_bboxes == 1:
-                bboxes = mask_to_bboxes(final_mask)
-                with open(os.path.join(out_dir, box_name), "w") as f:
-                    for bbox in bboxes:
-                        f.write(" ".join([str(v) for v in bbox]) + "\n")
-            if output_bboxes == 2:
-                bboxes = mask_to_bboxes(final_mask, tess=True)
-                with open(os.path.join(out_dir, tess_box_name), "w") as f:
-                    for bbox, char in zip(bboxes, text):
-                        f.write(
-                            " ".join([char] + [str(v) for v in bbox] + ["0"]) + "\n"
-                        )
-            
-            return meta_data
+        return make_filename_valid(name, allow_unicode=True)
+
+    @classmethod
+    def _background(
+        cls,
+        background_type: int,
+        height: int,
+        width: int,
+        image_dir: str,
+        rng: rnd.Random = rnd,
+        images: List[str] = None,
+    ) -> Image:
+        """
+        Create a background image of the given type, images are the file
+        names image backgrounds are picked from (all of image_dir by default)
+        """
+
+        if background_type == 0:
+            return background_generator.gaussian_noise(height, width, rng)
+        elif background_type == 1:
+            return background_generator.plain_white(height, width)
+        elif background_type == 2:
+            return background_generator.quasicrystal(height, width, rng)
+        elif background_type == 3:
+            rand_num = rng.random()  # Random float between 0 and 1
+            if rand_num > 0.3:
+                return background_generator.plain_white(height, width)
+            else:
+                return background_generator.gaussian_noise(height, width, rng)
         else:
-            if output_mask == 1:
-                raise Exception("output mask = 1")
-                
-            return final_image, meta_data
+            return background_generator.image(height, width, image_dir, rng, images)
+
+    @classmethod
+    def _contrast_precheck(
+        cls, text_color: str, background_type: int, image_dir: str
+    ) -> Tuple:
+        """
+        Run the contrast check on the text color alone, before rendering. The
+        mean of plain white and gaussian noise backgrounds is known, the mean
+        of every background image is read once. Return whether the color
+        can be used, and the images that are not too close to it for image
+        backgrounds (None for the other types). The check on the final pixels
+        still runs, random crops of an image can differ from its mean.
+        """
+
+        text_mean = ImageColor.getrgb(text_color)[:3]
+        if background_type == 0:
+            return not cls._too_close(text_mean, [235, 235, 235]), None
+        elif background_type == 1:
+            return not cls._too_close(text_mean, [255, 255, 255]), None
+        elif background_type == 3:
+            return (
+                not cls._too_close(text_mean, [235, 235, 235])
+                or not cls._too_close(text_mean, [255, 255, 255]),
+                None,
+            )
+        elif background_type == 4:
+            means = {
+                name: background_generator.image_mean(os.path.join(image_dir, name))
+                for name in background_generator.image_names(image_dir)
+            }
+            # Files that cannot be read are left out
+            means = {name: mean for name, mean in means.items() if mean is not None}
+            images = [
+                name
+                for name, mean in means.items()
+                if not cls._too_close(text_mean, mean)
+            ]
+            # Without any image, background_generator.image raises the error
+            return len(images) > 0 or len(means) == 0, images
+        # Quasicrystals have no known mean
+        return True, None
+
+    @classmethod
+    def _low_contrast(
+        cls, text_img: Image, text_mask: Image, background_img: Image
+    ) -> bool:
+        """
+        Compare the luminance of the text with the background's
+        """
+
+        text_img_st = ImageStat.Stat(text_img, text_mask.split()[2])
+        background_img_st = ImageStat.Stat(background_img)
+
+        if cls._too_close(text_img_st.mean, background_img_st.mean):
+            counters.increment("low_contrast")
+            counters.log(
+                "Mean pixel values too similar, text {} and background {}. "
+                "Ignore this image".format(text_img_st.mean, background_img_st.mean)
+            )
+            return True
+        return False
+
+    @classmethod
+    def _too_close(cls, text_mean: List[float], background_mean: List[float]) -> bool:
+        """
+        Compare the luminance of the text and of the background from their
+        channel means, alpha excluded. Less than 15 levels apart is too close.
+        """
+
+        return abs(cls._luminance(text_mean) - cls._luminance(background_mean)) < 15
+
+    @classmethod
+    def _luminance(cls, mean: List[float]) -> float:
+        """
+        Luminance (ITU-R 601-2, as Image.convert("L")) of RGB(A) channel means,
+        the first channel of grayscale ones
+        """
+
+        if len(mean) < 3:
+            return mean[0]
+        return 0.299 * mean[0] + 0.587 * mean[1] + 0.114 * mean[2]
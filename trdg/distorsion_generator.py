@@ -3,11 +3,54 @@ import math
 import os
 import random as rnd
 import numpy as np
-from typing import Tuple
+from typing import List, Tuple
 
 from PIL import Image
 
 
+def compute_offsets(
+    width: int, height: int, vertical: bool, horizontal: bool, func
+) -> Tuple[List[int], List[int]]:
+    """
+    Compute the per-column (vertical) and per-row (horizontal) pixel offsets
+    that a distortion function produces for an image of the given size
+    """
+
+    vertical_offsets = [func(i) for i in range(width)]
+    horizontal_offsets = [
+        func(i)
+        for i in range(
+            height
+            + (
+                (max(vertical_offsets) - min(min(vertical_offsets), 0))
+                if vertical
+                else 0
+            )
+        )
+    ]
+
+    return vertical_offsets, horizontal_offsets
+
+
+def distorsion_function(
+    distorsion_type: int, height: int, rng: rnd.Random = rnd
+) -> Tuple:
+    """
+    Return the maximum offset and the offset function of a distortion type
+    (1: Sine wave, 2: Cosine wave, 3: Random) for an image of a given height
+    """
+
+    if distorsion_type == 1:
+        max_offset = int(height**0.5)
+        return max_offset, (lambda x: int(math.sin(math.radians(x)) * max_offset))
+    elif distorsion_type == 2:
+        max_offset = int(height**0.5)
+        return max_offset, (lambda x: int(math.cos(math.radians(x)) * max_offset))
+    else:
+        max_offset = int(height**0.4)
+        return max_offset, (lambda x: rng.randint(0, max_offset))
+
+
 def _apply_func_distorsion(
     image: Image, mask: Image, vertical: bool, horizontal: bool, max_offset: int, func
 ) -> Tuple:
@@ -15,6 +58,38 @@ def _apply_func_distorsion(
     Apply a distortion to an image
     """
 
+    # Nothing to do!
+    if not vertical and not horizontal:
+        return image, mask
+
+    vertical_offsets, horizontal_offsets = compute_offsets(
+        image.size[0], image.size[1], vertical, horizontal, func
+    )
+
+    return apply_offsets(
+        image,
+        mask,
+        vertical,
+        horizontal,
+        max_offset,
+        vertical_offsets,
+        horizontal_offsets,
+    )
+
+
+def apply_offsets(
+    image: Image,
+    mask: Image,
+    vertical: bool,
+    horizontal: bool,
+    max_offset: int,
+    vertical_offsets: List[int],
+    horizontal_offsets: List[int],
+) -> Tuple:
+    """
+    Apply precomputed distortion offsets to an image and its mask
+    """
+
     # Nothing to do!
     if not vertical and not horizontal:
         return image, mask
@@ -26,19 +101,6 @@ def _apply_func_distorsion(
     img_arr = np.array(rgb_image)
     mask_arr = np.array(rgb_mask)
 
-    vertical_offsets = [func(i) for i in range(img_arr.shape[1])]
-    horizontal_offsets = [
-        func(i)
-        for i in range(
-            img_arr.shape[0]
-            + (
-                (max(vertical_offsets) - min(min(vertical_offsets), 0))
-                if vertical
-                else 0
-            )
-        )
-    ]
-
     new_img_arr = np.zeros(
         (
             img_arr.shape[0] + (2 * max_offset if vertical else 0),
@@ -107,16 +169,9 @@ def sin(
     Apply a sine distortion on one or both of the specified axis
     """
 
-    max_offset = int(image.height**0.5)
+    max_offset, func = distorsion_function(1, image.height)
 
-    return _apply_func_distorsion(
-        image,
-        mask,
-        vertical,
-        horizontal,
-        max_offset,
-        (lambda x: int(math.sin(math.radians(x)) * max_offset)),
-    )
+    return _apply_func_distorsion(image, mask, vertical, horizontal, max_offset, func)
 
 
 def cos(
@@ -126,16 +181,9 @@ def cos(
     Apply a cosine distortion on one or both of the specified axis
     """
 
-    max_offset = int(image.height**0.5)
+    max_offset, func = distorsion_function(2, image.height)
 
-    return _apply_func_distorsion(
-        image,
-        mask,
-        vertical,
-        horizontal,
-        max_offset,
-        (lambda x: int(math.cos(math.radians(x)) * max_offset)),
-    )
+    return _apply_func_distorsion(image, mask, vertical, horizontal, max_offset, func)
 
 
 def random(
@@ -145,13 +193,6 @@ def random(
     Apply a random distortion on one or both of the specified axis
     """
 
-    max_offset = int(image.height**0.4)
+    max_offset, func = distorsion_function(3, image.height)
 
-    return _apply_func_distorsion(
-        image,
-        mask,
-        vertical,
-        horizontal,
-        max_offset,
-        (lambda x: rnd.randint(0, max_offset)),
-    )
+    return _apply_func_distorsion(image, mask, vertical, horizontal, max_offset, func)
@@ -45,6 +45,21 @@ class GeneratorFromDict:
         output_bboxes: int = 0,
         path: str = "",
         rtl: bool = False,
+        fused_geometry: bool = False,
+        direct_render: bool = False,
+        analytic_bboxes: bool = False,
+        output_annotations: bool = False,
+        line_crops: bool = False,
+        variants_per_render: int = 1,
+        pyramid_sizes: List[int] = None,
+        max_resamples: int = 0,
+        bucket_batch_size: int = 0,
+        bucket_padding: float = 0.1,
+        num_workers: int = 0,
+        prefetch: int = 0,
+        ordered: bool = True,
+        shared_memory_slots: int = 0,
+        shared_memory_slot_size: int = 1 << 22,
     ):
         self.count = count
         self.length = length
@@ -94,6 +109,21 @@ class GeneratorFromDict:
             image_mode,
             output_bboxes,
             rtl,
+            fused_geometry=fused_geometry,
+            direct_render=direct_render,
+            analytic_bboxes=analytic_bboxes,
+            output_annotations=output_annotations,
+            line_crops=line_crops,
+            variants_per_render=variants_per_render,
+            pyramid_sizes=pyramid_sizes,
+            max_resamples=max_resamples,
+            bucket_batch_size=bucket_batch_size,
+            bucket_padding=bucket_padding,
+            num_workers=num_workers,
+            prefetch=prefetch,
+            ordered=ordered,
+            shared_memory_slots=shared_memory_slots,
+            shared_memory_slot_size=shared_memory_slot_size,
         )
 
     def __iter__(self):
@@ -103,9 +133,29 @@ class GeneratorFromDict:
         return self.next()
 
     def next(self):
+        self.update_strings()
+        return self.generator.next()
+
+    def update_strings(self):
+        # Draw new strings once the current ones have all been used
         if self.generator.generated_count >= self.steps_until_regeneration:
             self.generator.strings = create_strings_from_dict(
                 self.length, self.allow_variable, self.batch_size, self.dict
             )
             self.steps_until_regeneration += self.batch_size
-        return self.generator.next()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.update_strings()
+        return await self.generator.__anext__()
+
+    async def aclose(self):
+        await self.generator.aclose()
+
+    def release(self, slot: int):
+        self.generator.release(slot)
+
+    def close(self):
+        self.generator.close()
@@ -1,7 +1,19 @@
+import asyncio
+import functools
+import math
 import os
+import queue
+import random as rnd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Pool
 from typing import List, Tuple
 
+import cv2
+
+from trdg import computer_text_generator
 from trdg.data_generator import FakeTextDataGenerator
+from trdg.shared_buffer import SharedRingBuffer, generate_into_slot
 from trdg.utils import load_dict, load_fonts
 
 # support RTL
@@ -9,6 +21,13 @@ from arabic_reshaper import ArabicReshaper
 from bidi.algorithm import get_display
 
 
+def _seed_worker():
+    # Forked workers inherit the state of the random generators, reseed them
+    # so that they do not all draw the same augmentations
+    rnd.seed()
+    cv2.setRNGSeed(rnd.randrange(2 ** 31))
+
+
 class GeneratorFromStrings:
     """Generator that uses a given list of strings"""
 
@@ -45,6 +64,21 @@ class GeneratorFromStrings:
         image_mode: str = "RGB",
         output_bboxes: int = 0,
         rtl: bool = False,
+        fused_geometry: bool = False,
+        direct_render: bool = False,
+        analytic_bboxes: bool = False,
+        output_annotations: bool = False,
+        line_crops: bool = False,
+        variants_per_render: int = 1,
+        pyramid_sizes: List[int] = None,
+        max_resamples: int = 0,
+        bucket_batch_size: int = 0,
+        bucket_padding: float = 0.1,
+        num_workers: int = 0,
+        prefetch: int = 0,
+        ordered: bool = True,
+        shared_memory_slots: int = 0,
+        shared_memory_slot_size: int = 1 << 22,
     ):
         self.count = count
         self.strings = strings
@@ -89,6 +123,42 @@ class GeneratorFromStrings:
         self.stroke_width = stroke_width
         self.stroke_fill = stroke_fill
         self.image_mode = image_mode
+        self.fused_geometry = fused_geometry
+        self.direct_render = direct_render
+        self.analytic_bboxes = analytic_bboxes
+        self.output_annotations = output_annotations
+        self.line_crops = line_crops
+        self.variants_per_render = variants_per_render
+        self.pyramid_sizes = pyramid_sizes
+        self.max_resamples = max_resamples
+        self.render_count = 0
+        self.variants = []
+        self.bucket_batch_size = bucket_batch_size
+        self.bucket_padding = bucket_padding
+        self.queued_count = 0
+        self.buckets = {}
+        if self.bucket_batch_size > 0 and (
+            self.orientation != 0 or self.is_handwritten
+        ):
+            raise ValueError("Batches can only be made of horizontal computer text")
+        self.num_workers = num_workers
+        self.prefetch = prefetch if prefetch > 0 else 2 * num_workers
+        self.ordered = ordered
+        self.shared_memory_slots = shared_memory_slots
+        self.shared_memory_slot_size = shared_memory_slot_size
+        if self.shared_memory_slots > 0 and (
+            self.num_workers == 0 or self.variants_per_render > 1
+        ):
+            raise ValueError(
+                "Shared memory needs workers and a single variant per render"
+            )
+        self.pool = None
+        self.buffer = None
+        self.executor = None
+        self.futures = []
+        self.pending = deque()
+        self.finished = queue.Queue()
+        self.in_flight = 0
 
     def __iter__(self):
         return self
@@ -97,15 +167,38 @@ class GeneratorFromStrings:
         return self.next()
 
     def next(self):
+        if self.bucket_batch_size > 0:
+            return self.next_batch()
         if self.generated_count == self.count:
+            self.close()
             raise StopIteration
         self.generated_count += 1
-        
+
+        if len(self.variants) == 0:
+            if self.num_workers > 0:
+                results, label = self.next_from_workers()
+            else:
+                args, kwargs, label = self.render_task(self.render_count)
+                self.render_count += 1
+                results = FakeTextDataGenerator.generate(*args, **kwargs)
+            # Every variant of a render is returned before rendering again
+            if self.variants_per_render == 1:
+                results = [results]
+            self.variants = [(result, label) for result in results]
+
+        return self.variants.pop(0)
+
+    def render_task(self, i: int) -> Tuple:
+        """
+        Return the positional and keyword arguments of
+        FakeTextDataGenerator.generate for the i-th render, and its label
+        """
+
         return (
-            FakeTextDataGenerator.generate(
-                self.generated_count,
-                self.strings[(self.generated_count - 1) % len(self.strings)],
-                self.fonts[(self.generated_count - 1) % len(self.fonts)],
+            (
+                i * self.variants_per_render + 1,
+                self.strings[i % len(self.strings)],
+                self.fonts[i % len(self.fonts)],
                 None,
                 self.size,
                 None,
@@ -134,10 +227,290 @@ class GeneratorFromStrings:
                 self.image_mode,
                 self.output_bboxes,
             ),
-            self.orig_strings[(self.generated_count - 1) % len(self.orig_strings)]
+            dict(
+                fused_geometry=self.fused_geometry,
+                direct_render=self.direct_render,
+                analytic_bboxes=self.analytic_bboxes,
+                output_annotations=self.output_annotations,
+                line_crops=self.line_crops,
+                variants_per_render=self.variants_per_render,
+                pyramid_sizes=self.pyramid_sizes,
+                max_resamples=self.max_resamples,
+            ),
+            self.orig_strings[i % len(self.orig_strings)]
             if self.rtl
-            else self.strings[(self.generated_count - 1) % len(self.strings)],
+            else self.strings[i % len(self.strings)],
+        )
+
+    def next_from_workers(self) -> Tuple:
+        """
+        Keep up to prefetch renders in flight in the worker processes and
+        return the next finished one with its label, in submission order if
+        ordered is set, as soon as it is done otherwise
+        """
+
+        if self.pool is None:
+            # The buffer is created first so that the workers share the
+            # resource tracker of this process instead of starting their own,
+            # which would remove the shared memory when they exit
+            if self.shared_memory_slots > 0:
+                self.buffer = SharedRingBuffer(
+                    self.shared_memory_slots, self.shared_memory_slot_size
+                )
+            self.pool = Pool(self.num_workers, initializer=_seed_worker)
+
+        # Only as many renders as needed to reach count are submitted
+        renders = -(-self.count // self.variants_per_render)
+        while (
+            self.in_flight < self.prefetch
+            and (self.count == -1 or self.render_count < renders)
+            and (self.buffer is None or len(self.buffer.free) > 0)
+        ):
+            args, kwargs, label = self.render_task(self.render_count)
+            self.render_count += 1
+            self.in_flight += 1
+            func, slot = FakeTextDataGenerator.generate, None
+            if self.buffer is not None:
+                # The worker writes the image to the slot and only sends back
+                # its shape and the metadata
+                slot = self.buffer.acquire()
+                func, args, kwargs = (
+                    generate_into_slot,
+                    (self.buffer.name, self.buffer.slot_size, slot, args, kwargs),
+                    {},
+                )
+            if self.ordered:
+                self.pending.append(
+                    (self.pool.apply_async(func, args, kwargs), label, slot)
+                )
+            else:
+                self.pool.apply_async(
+                    func,
+                    args,
+                    kwargs,
+                    callback=lambda result, label=label, slot=slot: self.finished.put(
+                        (True, result, label, slot)
+                    ),
+                    error_callback=lambda err, slot=slot: self.finished.put(
+                        (False, err, None, slot)
+                    ),
+                )
+
+        if self.in_flight == 0:
+            raise RuntimeError("All the shared memory slots are held, release some")
+        self.in_flight -= 1
+
+        if self.ordered:
+            async_result, label, slot = self.pending.popleft()
+            try:
+                result = async_result.get()
+            except Exception:
+                if slot is not None:
+                    self.buffer.release(slot)
+                raise
+        else:
+            success, result, label, slot = self.finished.get()
+            if not success:
+                if slot is not None:
+                    self.buffer.release(slot)
+                raise result
+
+        if slot is None:
+            return result, label
+
+        shape, meta_data = result
+        if shape is None:
+            self.buffer.release(slot)
+            return None, label
+        meta_data["slot"] = slot
+        return (self.buffer.view(slot, shape), meta_data), label
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.bucket_batch_size > 0 or self.shared_memory_slots > 0:
+            raise ValueError("Batches and shared memory are not available in async")
+        if self.generated_count == self.count:
+            self.close()
+            raise StopAsyncIteration
+
+        if len(self.variants) == 0:
+            results, label = await self.next_async()
+            # Every variant of a render is returned before rendering again
+            if self.variants_per_render == 1:
+                results = [results]
+            self.variants = [(result, label) for result in results]
+
+        # Counted only now, as the await above may be cancelled
+        self.generated_count += 1
+        return self.variants.pop(0)
+
+    async def next_async(self) -> Tuple:
+        """
+        Same as next_from_workers, but the renders run in an executor
+        (worker processes, or one thread without num_workers) so that the
+        event loop is never blocked. If the awaiting task is cancelled, the
+        renders in flight are kept for the next call.
+        """
+
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            self.executor = (
+                ProcessPoolExecutor(self.num_workers, initializer=_seed_worker)
+                if self.num_workers > 0
+                else ThreadPoolExecutor(1)
+            )
+
+        renders = -(-self.count // self.variants_per_render)
+        while len(self.futures) < max(self.prefetch, 1) and (
+            self.count == -1 or self.render_count < renders
+        ):
+            args, kwargs, label = self.render_task(self.render_count)
+            self.render_count += 1
+            future = loop.run_in_executor(
+                self.executor,
+                functools.partial(FakeTextDataGenerator.generate, *args, **kwargs),
+            )
+            self.futures.append((future, label))
+
+        if self.ordered:
+            future, label = self.futures[0]
+            await asyncio.shield(future)
+        else:
+            done, _ = await asyncio.wait(
+                [future for future, _ in self.futures],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            future, label = next(
+                (future, label) for future, label in self.futures if future in done
+            )
+        self.futures.remove((future, label))
+
+        return future.result(), label
+
+    async def aclose(self):
+        """
+        Cancel the renders in flight and stop the executor
+        """
+
+        for future, _ in self.futures:
+            future.cancel()
+        self.futures = []
+        self.close()
+
+    def release(self, slot: int):
+        """
+        Give back the shared memory slot of an image (meta_data["slot"]) once
+        it is not used anymore
+        """
+
+        self.buffer.release(slot)
+
+    def close(self):
+        """
+        Stop the worker processes and the executor, if any
+        """
+
+        if getattr(self, "pool", None) is not None:
+            self.pool.terminate()
+            self.pool = None
+        if getattr(self, "buffer", None) is not None:
+            self.buffer.close()
+            self.buffer = None
+        if getattr(self, "executor", None) is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def __del__(self):
+        self.close()
+
+    def next_batch(self):
+        """
+        Return the next (images, widths, labels) batch of bucket_batch_size
+        samples made with FakeTextDataGenerator.generate_batch. The output
+        width of every string is predicted before rendering and the strings
+        are put in buckets whose widths are within bucket_padding of each
+        other, so that a batch is padded by less than that ratio of its width.
+        """
+
+        while True:
+            full = [
+                key
+                for key, pending in self.buckets.items()
+                if len(pending) >= self.bucket_batch_size
+            ]
+            if len(full) > 0:
+                batch = self.buckets[full[0]][: self.bucket_batch_size]
+                del self.buckets[full[0]][: self.bucket_batch_size]
+                break
+            if self.queued_count == self.count:
+                # No more strings, flush the fullest bucket
+                pending = [key for key, batch in self.buckets.items() if batch]
+                if len(pending) == 0:
+                    raise StopIteration
+                batch = self.buckets.pop(
+                    max(pending, key=lambda key: len(self.buckets[key]))
+                )
+                break
+
+            i = self.queued_count
+            self.queued_count += 1
+            text = self.strings[i % len(self.strings)]
+            font = self.fonts[i % len(self.fonts)]
+            margin_top, _, margin_bottom, _ = (
+                self.margins if isinstance(self.margins[0], int) else self.margins[0]
+            )
+            width = computer_text_generator.predict_width(
+                text,
+                font,
+                self.size,
+                self.size - margin_top - margin_bottom,
+                self.skewing_angle if not self.random_skew else 0,
+                self.distorsion_type,
+                self.space_width,
+                self.character_spacing,
+                self.word_split,
+                self.fit,
+            )
+            label = (
+                self.orig_strings[i % len(self.orig_strings)]
+                if self.rtl
+                else text
+            )
+            self.buckets.setdefault(
+                int(math.log(width) / math.log(1 + self.bucket_padding)), []
+            ).append((text, font, label))
+
+        images, widths, texts = FakeTextDataGenerator.generate_batch(
+            [text for text, _, _ in batch],
+            [font for _, font, _ in batch],
+            self.size,
+            self.skewing_angle,
+            self.random_skew,
+            self.blur,
+            self.random_blur,
+            self.background_type,
+            self.distorsion_type,
+            self.distorsion_orientation,
+            self.text_color,
+            self.space_width,
+            self.character_spacing,
+            self.margins,
+            self.fit,
+            self.word_split,
+            self.image_dir,
+            self.stroke_width,
+            self.stroke_fill,
+            self.image_mode,
+            fused_geometry=self.fused_geometry,
+            direct_render=self.direct_render,
         )
+        self.generated_count += len(batch)
+
+        # Samples dropped by the contrast check are missing from the batch
+        labels = dict((text, label) for text, _, label in batch)
+        return images, widths, [labels[text] for text in texts]
 
     def reshape_rtl(self, strings: list, rtl_shaper: ArabicReshaper):
         # reshape RTL characters before generating any image
@@ -0,0 +1,264 @@
+import cv2
+import math
+import random as rnd
+import numpy as np
+from typing import Callable, Optional, Tuple
+
+from PIL import Image
+
+from trdg import distorsion_generator
+
+
+def rotation_matrix(size: Tuple[int, int], angle: float) -> Tuple:
+    """
+    Compute the inverse affine matrix and the output size of an expanded
+    rotation, exactly as Image.rotate(angle, expand=1) does
+    """
+
+    w, h = size
+    degrees = angle % 360.0
+
+    if degrees == 0:
+        return [1.0, 0.0, 0.0, 0.0, 1.0, 0.0], (w, h)
+
+    center = (w / 2, h / 2)
+    angle = -math.radians(degrees)
+    matrix = [
+        round(math.cos(angle), 15),
+        round(math.sin(angle), 15),
+        0.0,
+        round(-math.sin(angle), 15),
+        round(math.cos(angle), 15),
+        0.0,
+    ]
+
+    def transform(x, y, matrix):
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+
+    matrix[2], matrix[5] = transform(-center[0], -center[1], matrix)
+    matrix[2] += center[0]
+    matrix[5] += center[1]
+
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        x, y = transform(x, y, matrix)
+        xx.append(x)
+        yy.append(y)
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+
+    # Image.rotate transposes right angles instead of resampling them
+    if degrees in (90, 270):
+        nw, nh = h, w
+    elif degrees == 180:
+        nw, nh = w, h
+
+    matrix[2], matrix[5] = transform(-(nw - w) / 2.0, -(nh - h) / 2.0, matrix)
+
+    return matrix, (nw, nh)
+
+
+def distorsion_field(
+    distorsion_type: int,
+    size: Tuple[int, int],
+    vertical: bool,
+    horizontal: bool,
+    rng: rnd.Random = rnd,
+) -> Tuple:
+    """
+    Compute the offsets of a distortion for an image of the given size.
+    Returns the maximum offset, the per-column and per-row offsets and the
+    size of the distorted image.
+    """
+
+    w, h = size
+
+    if distorsion_type == 0 or (not vertical and not horizontal):
+        return 0, None, None, (w, h)
+
+    max_offset, func = distorsion_generator.distorsion_function(
+        distorsion_type, h, rng
+    )
+    vertical_offsets, horizontal_offsets = distorsion_generator.compute_offsets(
+        w, h, vertical, horizontal, func
+    )
+
+    return (
+        max_offset,
+        np.array(vertical_offsets) if vertical else None,
+        np.array(horizontal_offsets) if horizontal else None,
+        (
+            w + (2 * max_offset if horizontal else 0),
+            h + (2 * max_offset if vertical else 0),
+        ),
+    )
+
+
+def build_maps(
+    size: Tuple[int, int],
+    angle: float,
+    distorsion_type: int,
+    vertical: bool,
+    horizontal: bool,
+    target_size: Optional[Callable] = None,
+    supersampling: int = 1,
+    field: Optional[Tuple] = None,
+) -> Tuple:
+    """
+    Compose rotation, distortion and resize into a single coordinate map.
+    For every output pixel, the maps hold the position of the source pixel
+    in the rendered text image (cv2.remap convention). With supersampling,
+    the maps cover the output size times that factor on each axis.
+    """
+
+    matrix, rotated_size = rotation_matrix(size, angle)
+    if field is None:
+        field = distorsion_field(distorsion_type, rotated_size, vertical, horizontal)
+    max_offset, vertical_offsets, horizontal_offsets, distorted_size = field
+    out_w, out_h = (
+        target_size(*distorted_size) if target_size is not None else distorted_size
+    )
+    map_w, map_h = out_w * supersampling, out_h * supersampling
+
+    # Resize: output pixel centers to distorted image coordinates
+    x = (np.arange(map_w, dtype=np.float64) + 0.5) * (distorted_size[0] / map_w) - 0.5
+    y = (np.arange(map_h, dtype=np.float64) + 0.5) * (distorted_size[1] / map_h) - 0.5
+    x, y = np.meshgrid(x, y)
+    invalid = np.zeros(x.shape, dtype=bool)
+
+    # Distortion: undo the per-row then the per-column integer shifts
+    if horizontal_offsets is not None:
+        rows = np.rint(y).astype(np.int64)
+        invalid |= (rows < 0) | (rows >= len(horizontal_offsets))
+        x = x - horizontal_offsets[np.clip(rows, 0, len(horizontal_offsets) - 1)]
+    if vertical_offsets is not None:
+        columns = np.rint(x).astype(np.int64) - (max_offset if horizontal else 0)
+        invalid |= (columns < 0) | (columns >= len(vertical_offsets))
+        y = y - max_offset - vertical_offsets[
+            np.clip(columns, 0, len(vertical_offsets) - 1)
+        ]
+    if horizontal_offsets is not None:
+        x = x - max_offset
+
+    # Rotation: the PIL matrix already maps destination to source
+    a, b, c, d, e, f = matrix
+    map_x = a * (x + 0.5) + b * (y + 0.5) + c - 0.5
+    map_y = d * (x + 0.5) + e * (y + 0.5) + f - 0.5
+    map_x[invalid] = -1
+    map_y[invalid] = -1
+
+    return map_x.astype(np.float32), map_y.astype(np.float32), (out_w, out_h)
+
+
+def fused_transform(
+    image: Image,
+    mask: Image,
+    angle: float,
+    distorsion_type: int,
+    vertical: bool,
+    horizontal: bool,
+    target_size: Optional[Callable] = None,
+    field: Optional[Tuple] = None,
+) -> Tuple:
+    """
+    Rotate, distort and resize an image and its mask with one remap each,
+    without producing any intermediate image. A distortion field computed
+    beforehand with distorsion_field can be given to reuse its offsets.
+    """
+
+    out_size = target_size(*image.size) if target_size is not None else image.size
+
+    # Without skew nor distortion, there is nothing to fuse
+    if angle % 360.0 == 0 and (
+        distorsion_type == 0 or (not vertical and not horizontal)
+    ):
+        if out_size == image.size:
+            return image, mask
+        return (
+            image.resize(out_size, Image.Resampling.LANCZOS),
+            mask.resize(out_size, Image.Resampling.NEAREST),
+        )
+
+    # Bilinear sampling aliases when shrinking, so the image is sampled on a
+    # grid as fine as the source and box-filtered down to the output size
+    supersampling = min(
+        max(int(math.ceil(image.size[1] / max(out_size[1], 1))), 1), 4
+    )
+
+    map_x, map_y, (out_w, out_h) = build_maps(
+        image.size,
+        angle,
+        distorsion_type,
+        vertical,
+        horizontal,
+        target_size,
+        supersampling,
+        field,
+    )
+
+    # Interpolating premultiplied alpha keeps transparent pixels from
+    # bleeding their (black) color into the glyph edges
+    img_arr = cv2.remap(
+        np.asarray(image.convert("RGBa")),
+        map_x,
+        map_y,
+        interpolation=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=0,
+    )
+    mask_arr = cv2.remap(
+        np.asarray(mask.convert("RGB")),
+        map_x[supersampling // 2 :: supersampling, supersampling // 2 :: supersampling],
+        map_y[supersampling // 2 :: supersampling, supersampling // 2 :: supersampling],
+        interpolation=cv2.INTER_NEAREST,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=0,
+    )
+    if supersampling > 1:
+        img_arr = cv2.resize(img_arr, (out_w, out_h), interpolation=cv2.INTER_AREA)
+
+    return (
+        Image.fromarray(img_arr, "RGBa").convert("RGBA"),
+        Image.fromarray(mask_arr, "RGB"),
+    )
+
+
+def transform_points(
+    points: np.ndarray,
+    size: Tuple[int, int],
+    angle: float,
+    field: Tuple,
+    out_size: Tuple[int, int],
+) -> np.ndarray:
+    """
+    Map points (array of shape (..., 2), in pixel edge coordinates) of the
+    rendered text image through the rotation, the distortion field and the
+    resize to out_size, the same way the image itself is transformed
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+    max_offset, vertical_offsets, horizontal_offsets, distorted_size = field
+
+    # Rotation: invert the destination to source matrix
+    (a, b, c, d, e, f), _ = rotation_matrix(size, angle)
+    det = a * e - b * d
+    x = points[..., 0] - c
+    y = points[..., 1] - f
+    x, y = (e * x - b * y) / det, (a * y - d * x) / det
+
+    # Distortion: apply the per-column then the per-row integer shifts
+    if vertical_offsets is not None:
+        columns = np.clip(np.floor(x).astype(np.int64), 0, len(vertical_offsets) - 1)
+        y = y + max_offset + vertical_offsets[columns]
+    if horizontal_offsets is not None:
+        x = x + max_offset
+        rows = np.clip(np.floor(y).astype(np.int64), 0, len(horizontal_offsets) - 1)
+        x = x + horizontal_offsets[rows]
+
+    # Resize
+    x = x * (out_size[0] / distorted_size[0])
+    y = y * (out_size[1] / distorted_size[1])
+
+    return np.stack([x, y], axis=-1)
@@ -7,12 +7,17 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import matplotlib.mlab as mlab
 import seaborn
+import threading
 from PIL import Image, ImageColor
 from collections import namedtuple
 import warnings
 
 warnings.filterwarnings("ignore")
 
+# The TensorFlow default graph, pyplot's current figure and numpy's global
+# generator are shared by the whole process, one text is written at a time
+_lock = threading.Lock()
+
 
 def download_model_weights() -> str:
     from pathlib import Path
@@ -176,7 +181,12 @@ def _join_images(images):
     return compound_image
 
 
-def generate(text, text_color):
+def generate(text, text_color, rng=rnd):
+    with _lock:
+        return _generate(text, text_color, rng)
+
+
+def _generate(text, text_color, rng):
     cd = download_model_weights()
     with open(
         os.path.join(cd, os.path.join("handwritten_model", "translation.pkl")), "rb"
@@ -197,9 +207,9 @@ def generate(text, text_color):
         c1, c2 = colors[0], colors[-1]
 
         color = "#{:02x}{:02x}{:02x}".format(
-            rnd.randint(min(c1[0], c2[0]), max(c1[0], c2[0])),
-            rnd.randint(min(c1[1], c2[1]), max(c1[1], c2[1])),
-            rnd.randint(min(c1[2], c2[2]), max(c1[2], c2[2])),
+            rng.randint(min(c1[0], c2[0]), max(c1[0], c2[0])),
+            rng.randint(min(c1[1], c2[1]), max(c1[1], c2[1])),
+            rng.randint(min(c1[2], c2[2]), max(c1[2], c2[2])),
         )
 
         for word in text.split(" "):
@@ -0,0 +1,65 @@
+"""
+Counters of what happened during the generation: samples written, samples
+rejected for a low contrast, font fallbacks and errors. Every process counts
+into its own counters, the counts are sent back to the parent along with the
+results and merged there, like the stage timers.
+"""
+
+import threading
+from collections import Counter
+from typing import Callable, Dict, Tuple
+
+# Report order, counters that are not listed come after
+COUNTERS = ["written", "low_contrast", "resampled", "font_fallback", "error"]
+
+
+class Counters(object):
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def increment(self, name: str, count: int = 1):
+        with self.lock:
+            self.counts[name] += count
+
+    def log(self, message: str):
+        """
+        Print a per-sample message, only in verbose mode
+        """
+
+        if self.verbose:
+            print(message)
+
+    def drain(self) -> Dict[str, int]:
+        """
+        Return the counts since the last call and reset them
+        """
+
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        return dict(counts)
+
+    def merge(self, counts: Dict[str, int]):
+        with self.lock:
+            self.counts.update(counts)
+
+    def summary(self) -> Dict[str, int]:
+        with self.lock:
+            order = COUNTERS + sorted(set(self.counts) - set(COUNTERS))
+            return {name: self.counts[name] for name in order}
+
+
+# Counters of the current process
+counters = Counters()
+
+
+def counted_call(func: Callable, verbose: bool, args: Tuple) -> Tuple:
+    """
+    Call func(args) and return its result along with the counts of the
+    process since the last call
+    """
+
+    counters.verbose = verbose
+    result = func(args)
+    return result, counters.drain()
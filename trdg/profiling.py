@@ -0,0 +1,456 @@
+"""
+Timers for the stages of the generation pipeline. Every process records into
+its own timer, the durations (and the spans, when tracing) are sent back to
+the parent along with the results and merged there.
+
+Also per-worker cProfile capture, merged into one report by the parent.
+"""
+
+import cProfile
+import glob
+import io
+import json
+import multiprocessing
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from multiprocessing.util import Finalize
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+# Report order, stages that are not listed come after
+STAGES = [
+    "generate",
+    "precheck",
+    "font_size",
+    "render",
+    "distort_field",
+    "rotate",
+    "distort",
+    "resize",
+    "geometry",
+    "background",
+    "contrast",
+    "paste",
+    "convert",
+    "blur",
+    "name",
+    "encode",
+    "write",
+]
+
+_NULL_STAGE = nullcontext()
+
+
+class _Stage(object):
+    __slots__ = ("timer", "name", "start", "base", "peak")
+
+    def __init__(self, timer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.memory:
+            # The traced peak is global, hand it to the enclosing stages
+            # before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            stack = self.timer.stack()
+            for stage in stack:
+                stage.peak = max(stage.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+            stack.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start, self.start)
+        if self.timer.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            stack = self.timer.stack()
+            stack.pop()
+            for stage in stack:
+                stage.peak = max(stage.peak, self.peak)
+            self.timer.record_memory(self.name, self.peak - self.base)
+
+
+class StageTimer(object):
+    """
+    Collects the durations (in seconds) of named stages. When disabled,
+    stage() returns a shared no-op context manager and nothing is recorded.
+    When tracing, every stage is also kept as a span (name, start, duration,
+    pid, thread id, sample index) for the timeline. With memory, the peak of
+    the memory traced by tracemalloc (above its level when the stage
+    started) is recorded for every stage too. tracemalloc is process-wide:
+    with thread workers, the peaks of concurrent stages include each other.
+    """
+
+    def __init__(
+        self, enabled: bool = False, trace: bool = False, memory: bool = False
+    ):
+        self.enabled = enabled
+        self.trace = trace
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.spans = []
+        # Traced memory peaks (bytes) by stage and by sample type, and the
+        # peak resident set size (bytes) of each worker
+        self.peaks = {}
+        self.sample_peaks = {}
+        self.rss = {}
+        # Index of the sample being generated and open stages, by thread
+        self.local = threading.local()
+
+    def stack(self) -> List[_Stage]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, seconds: float, start: float = None):
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+            if self.trace:
+                self.spans.append(
+                    (
+                        name,
+                        start,
+                        seconds,
+                        os.getpid(),
+                        threading.get_ident(),
+                        getattr(self.local, "index", None),
+                    )
+                )
+
+    def record_memory(self, name: str, peak: int):
+        with self.lock:
+            self.peaks.setdefault(name, []).append(peak)
+
+    def record_sample(self, sample_type: str, peak: int):
+        """
+        Record the traced peak of a whole sample and the peak RSS of the
+        worker so far
+        """
+
+        with self.lock:
+            self.sample_peaks.setdefault(sample_type, []).append(peak)
+            self.rss[os.getpid()] = _peak_rss()
+
+    def drain(self) -> Dict:
+        """
+        Return everything recorded so far (to be merged in another timer)
+        and forget it
+        """
+
+        with self.lock:
+            data = {
+                "durations": self.durations,
+                "spans": self.spans,
+                "peaks": self.peaks,
+                "sample_peaks": self.sample_peaks,
+                "rss": self.rss,
+            }
+            self.durations, self.spans = {}, []
+            self.peaks, self.sample_peaks, self.rss = {}, {}, {}
+        return data
+
+    def merge(self, data: Dict):
+        with self.lock:
+            for name, values in data["durations"].items():
+                self.durations.setdefault(name, []).extend(values)
+            self.spans.extend(data["spans"])
+            for name, values in data["peaks"].items():
+                self.peaks.setdefault(name, []).extend(values)
+            for name, values in data["sample_peaks"].items():
+                self.sample_peaks.setdefault(name, []).extend(values)
+            for pid, rss in data["rss"].items():
+                self.rss[pid] = max(self.rss.get(pid, 0), rss)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Count, total, median and 95th percentile (in milliseconds) per stage
+        """
+
+        names = [s for s in STAGES if s in self.durations] + sorted(
+            s for s in self.durations if s not in STAGES
+        )
+        summary = {}
+        for name in names:
+            values = np.array(self.durations[name]) * 1000
+            summary[name] = {
+                "count": len(values),
+                "total_ms": float(values.sum()),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p95_ms": float(np.percentile(values, 95)),
+            }
+        return summary
+
+    def report(self) -> str:
+        lines = [
+            "{:<12} {:>8} {:>12} {:>10} {:>10}".format(
+                "stage", "count", "total (ms)", "p50 (ms)", "p95 (ms)"
+            )
+        ]
+        for name, stats in self.summary().items():
+            lines.append(
+                "{:<12} {:>8} {:>12.1f} {:>10.3f} {:>10.3f}".format(
+                    name,
+                    stats["count"],
+                    stats["total_ms"],
+                    stats["p50_ms"],
+                    stats["p95_ms"],
+                )
+            )
+        return "\n".join(lines)
+
+    def memory_summary(self) -> Dict:
+        """
+        Median and largest traced peak (in MB) per stage and per sample type,
+        and the peak RSS (in MB) of every worker
+        """
+
+        def peaks(groups, names):
+            summary = {}
+            for name in names:
+                values = np.array(groups[name]) / 2 ** 20
+                summary[name] = {
+                    "count": len(values),
+                    "p50_mb": float(np.percentile(values, 50)),
+                    "max_mb": float(values.max()),
+                }
+            return summary
+
+        return {
+            "stages": peaks(
+                self.peaks,
+                [s for s in STAGES if s in self.peaks]
+                + sorted(s for s in self.peaks if s not in STAGES),
+            ),
+            "samples": peaks(self.sample_peaks, sorted(self.sample_peaks)),
+            "worker_rss_mb": {
+                str(pid): rss / 2 ** 20 for pid, rss in sorted(self.rss.items())
+            },
+        }
+
+    def memory_report(self) -> str:
+        summary = self.memory_summary()
+        lines = []
+        for title, groups in [
+            ("stage", summary["stages"]),
+            ("sample type", summary["samples"]),
+        ]:
+            lines.append(
+                "{:<44} {:>8} {:>10} {:>10}".format(
+                    title, "count", "p50 (MB)", "max (MB)"
+                )
+            )
+            for name, stats in groups.items():
+                lines.append(
+                    "{:<44} {:>8} {:>10.2f} {:>10.2f}".format(
+                        name, stats["count"], stats["p50_mb"], stats["max_mb"]
+                    )
+                )
+            lines.append("")
+        lines.append("{:<44} {:>8}".format("worker", "peak RSS (MB)"))
+        for pid, rss in summary["worker_rss_mb"].items():
+            lines.append("{:<44} {:>8.1f}".format(pid, rss))
+        return "\n".join(lines)
+
+    def write_trace(self, path: str, origin: float = 0):
+        """
+        Write the spans as a Chrome Trace Event file (for Perfetto or
+        chrome://tracing), one track per worker thread. Times are relative
+        to origin (a time.perf_counter() value).
+        """
+
+        events = []
+        threads = {}
+        for name, start, seconds, pid, tid, index in self.spans:
+            # Thread idents are long and only unique within a process
+            if (pid, tid) not in threads:
+                threads[(pid, tid)] = len([t for t in threads if t[0] == pid])
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": threads[(pid, tid)],
+                        "args": {
+                            "name": "worker {}:{}".format(pid, threads[(pid, tid)])
+                        },
+                    }
+                )
+            events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - origin) * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": pid,
+                    "tid": threads[(pid, tid)],
+                    "args": {"index": index},
+                }
+            )
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# Timer of the current process
+timer = StageTimer()
+
+
+def _peak_rss() -> int:
+    """
+    Peak resident set size of the process in bytes, which includes the
+    pixels of Pillow images that tracemalloc does not see
+    """
+
+    # Kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (
+        1 if os.uname().sysname == "Darwin" else 1024
+    )
+
+
+def profiled_call(
+    func: Callable,
+    args: Tuple,
+    trace: bool = False,
+    memory: bool = False,
+    describe: Callable = None,
+) -> Tuple:
+    """
+    Call func(args) with the stage timer of the process enabled and return
+    its result along with everything recorded since the last call (see
+    StageTimer.drain). The first item of args is the index of the sample.
+    With memory, the peak of the whole call is also recorded under the
+    sample type returned by describe(args).
+    """
+
+    timer.enabled = True
+    timer.trace = trace
+    timer.memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    timer.local.index = args[0]
+    stage = timer.stage("generate")
+    with stage:
+        result = func(args)
+    if memory:
+        timer.record_sample(
+            describe(args) if describe is not None else "", stage.peak - stage.base
+        )
+    return result, timer.drain()
+
+
+# cProfile profilers of the current process, by thread
+_profilers = {}
+_profilers_lock = threading.Lock()
+
+
+def cprofiled_call(func: Callable, directory: str, args: Tuple):
+    """
+    Call func(args) under the cProfile profiler of the current thread. Pool
+    worker processes write their profiles to directory when they exit, the
+    process that owns thread workers has to call dump_profiles itself.
+    """
+
+    profiler = _profilers.get(threading.get_ident())
+    if profiler is None:
+        profiler = cProfile.Profile()
+        with _profilers_lock:
+            first = len(_profilers) == 0
+            _profilers[threading.get_ident()] = profiler
+        if first and multiprocessing.parent_process() is not None:
+            Finalize(None, dump_profiles, args=(directory,), exitpriority=10)
+    return profiler.runcall(func, args)
+
+
+def dump_profiles(directory: str):
+    """
+    Write the profile of every thread of the current process to directory
+    """
+
+    with _profilers_lock:
+        for ident, profiler in _profilers.items():
+            profiler.dump_stats(
+                os.path.join(directory, "{}-{}.prof".format(os.getpid(), ident))
+            )
+
+
+def _frame_name(func: Tuple) -> str:
+    file_name, line, name = func
+    if file_name == "~":
+        # Built-in functions
+        return name.replace(";", ",")
+    return "{} ({}:{})".format(name, os.path.basename(file_name), line).replace(
+        ";", ","
+    )
+
+
+def collapsed_stacks(stats: pstats.Stats, max_depth: int = 64) -> List[str]:
+    """
+    Approximate the call stacks of a profile in the collapsed format of
+    flamegraph tools ("frame;frame;frame microseconds"). cProfile only keeps
+    caller to callee edges, so the time of a function is split between its
+    call paths in proportion to the time of each edge.
+    """
+
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, edge_time) in callers.items():
+            callees.setdefault(caller, []).append((func, edge_time))
+
+    lines = {}
+
+    def walk(func, path, share):
+        # share: part of the cumulative time of func spent on this path
+        _, _, self_time, cumulative_time, _ = stats.stats[func]
+        path = path + [_frame_name(func)]
+        ratio = share / cumulative_time if cumulative_time > 0 else 0
+        stack = ";".join(path)
+        lines[stack] = lines.get(stack, 0) + self_time * ratio
+        if len(path) >= max_depth:
+            return
+        for callee, edge_time in callees.get(func, []):
+            if _frame_name(callee) not in path:
+                walk(callee, path, edge_time * ratio)
+
+    for func, (_, _, _, cumulative_time, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [], cumulative_time)
+
+    return [
+        "{} {}".format(stack, int(round(seconds * 1e6)))
+        for stack, seconds in sorted(lines.items())
+        if seconds * 1e6 >= 1
+    ]
+
+
+def write_profile_report(directory: str, sort: str = "cumulative") -> str:
+    """
+    Merge the profiles written to directory into report.txt (sorted by
+    sort) and stacks.folded. Returns the path of the report.
+    """
+
+    stream = io.StringIO()
+    stats = pstats.Stats(
+        *sorted(glob.glob(os.path.join(directory, "*.prof"))), stream=stream
+    )
+    stats.sort_stats(sort).print_stats()
+
+    report_path = os.path.join(directory, "report.txt")
+    with open(report_path, "w") as f:
+        f.write(stream.getvalue())
+    with open(os.path.join(directory, "stacks.folded"), "w") as f:
+        f.write("\n".join(collapsed_stacks(stats)) + "\n")
+    return report_path
@@ -1,5 +1,8 @@
 import argparse
 import errno
+import functools
+import hashlib
+import json
 import os
 import sys
 
@@ -8,11 +11,21 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import random as rnd
 import string
 import sys
+import time
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from tqdm import tqdm
 
 from trdg.data_generator import FakeTextDataGenerator
+from trdg.metrics import Counters, counted_call
+from trdg.profiling import (
+    StageTimer,
+    cprofiled_call,
+    dump_profiles,
+    profiled_call,
+    write_profile_report,
+)
 from trdg.string_generator import (
     create_strings_from_dict,
     create_strings_from_file,
@@ -22,6 +35,78 @@ from trdg.string_generator import (
 from trdg.utils import load_dict, load_fonts
 
 
+# Progress journal in the output directory: a header line with the seed and
+# the arguments of the run, then one line per finished task
+JOURNAL = "progress.jsonl"
+
+# Arguments that do not change the samples, they can differ on --resume
+RESUME_IGNORED = {
+    "journal",
+    "resume",
+    "thread_count",
+    "backend",
+    "profile_stages",
+    "profile_memory",
+    "cprofile",
+    "trace",
+    "metrics",
+    "verbose",
+}
+
+
+def task_seed(seed: int, index: int) -> int:
+    """
+    Seed of the task (render or page) at index, the same in every run with
+    the same seed
+    """
+
+    digest = hashlib.sha256("{}:{}".format(seed, index).encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def indexed_call(func, t: tuple) -> tuple:
+    """
+    Call func(t) and return the index of the task (first item of t) with its
+    result, rejected samples give no metadata to find it from
+    """
+
+    return t[0], func(t)
+
+
+def read_journal(path: str) -> tuple:
+    """
+    Read the header and the finished tasks ({index: samples}) of a journal,
+    and cut off the last line if the previous run stopped while writing it
+    """
+
+    done = {}
+    with open(path, "rb+") as f:
+        header = json.loads(f.readline())
+        end = f.tell()
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            done[entry["index"]] = entry["samples"]
+            end += len(line)
+        f.truncate(end)
+    return header, done
+
+
+def sample_type(t: tuple) -> str:
+    """
+    Describe the generate_from_tuple (or generate_page_from_tuple) arguments
+    t for the memory summary. Pages are always horizontal.
+    """
+
+    return "orientation={} background={} distorsion={}".format(
+        0 if isinstance(t[1], list) else t[18], t[10], t[11]
+    )
+
+
 def margins(margin):
     margins = margin.split(",")
     if len(margins) == 1:
@@ -123,6 +208,15 @@ def parse_arguments():
         help="Define the number of thread to use for image generation",
         default=1,
     )
+    parser.add_argument(
+        "-bk",
+        "--backend",
+        type=str,
+        nargs="?",
+        help="Run the -t workers as threads (no pickling, fonts and caches shared) or as processes",
+        choices=["threads", "processes"],
+        default="processes",
+    )
     parser.add_argument(
         "-e",
         "--extension",
@@ -200,7 +294,7 @@ def parse_arguments():
         "-obb",
         "--output_bboxes",
         type=int,
-        help="Define if the generator will return bounding boxes for the text, 1: Bounding box file, 2: Tesseract format",
+        help="Define if the generator will return bounding boxes for the text, 1: Bounding box file, 2: Tesseract format, 3: Quadrilaterals file",
         default=0,
     )
     parser.add_argument(
@@ -341,6 +435,160 @@ def parse_arguments():
         help="Define the image mode to be used. RGB is default, L means 8-bit grayscale images, 1 means 1-bit binary images stored with one pixel per byte, etc.",
         default="RGB",
     )
+    parser.add_argument(
+        "-bdp",
+        "--blured_data_percentage",
+        type=float,
+        nargs="?",
+        help="Define the fraction of the samples to which the gaussian blur is applied",
+        default=0.2,
+    )
+    parser.add_argument(
+        "-fg",
+        "--fused_geometry",
+        action="store_true",
+        help="Apply skewing, distortion and resizing as a single coordinate remap instead of three successive image transforms",
+        default=False,
+    )
+    parser.add_argument(
+        "-dr",
+        "--direct_render",
+        action="store_true",
+        help="Render horizontal text at the font size matching the requested height instead of resizing it afterwards",
+        default=False,
+    )
+    parser.add_argument(
+        "-abb",
+        "--analytic_bboxes",
+        action="store_true",
+        help="Compute the bounding boxes from the text layout instead of scanning the mask. Always used for quadrilaterals",
+        default=False,
+    )
+    parser.add_argument(
+        "-oa",
+        "--output_annotations",
+        action="store_true",
+        help="Write the word and line boxes of paragraph text (orientation 2) to annotations.jsonl in the output directory",
+        default=False,
+    )
+    parser.add_argument(
+        "-lc",
+        "--line_crops",
+        action="store_true",
+        help="For paragraph text (orientation 2), also save every line cropped from the paragraph image as its own sample, labels are written to line_labels.txt",
+        default=False,
+    )
+    parser.add_argument(
+        "-pl",
+        "--page_lines",
+        type=int,
+        nargs="?",
+        help="Compose this many horizontal text lines on one page sharing a single background and blur pass, then cut them back out as separate samples (0 to disable)",
+        default=0,
+    )
+    parser.add_argument(
+        "-pw",
+        "--page_width",
+        type=int,
+        nargs="?",
+        help="Width of the pages composed with --page_lines",
+        default=1024,
+    )
+    parser.add_argument(
+        "-vpr",
+        "--variants_per_render",
+        type=int,
+        nargs="?",
+        help="Number of samples generated from each text render, each with its own skew, distortion, background, blur and margins",
+        default=1,
+    )
+    parser.add_argument(
+        "-pyr",
+        "--pyramid",
+        type=int,
+        nargs="+",
+        help="Render every sample once at the largest of these heights and save it downscaled to each of them, in one subdirectory of the output directory per height",
+        default=None,
+    )
+    parser.add_argument(
+        "-mr",
+        "--max_resamples",
+        type=int,
+        nargs="?",
+        help="Generate a sample rejected for a too low contrast again, with a new text color, background, skew and margins, up to this many times, so that exactly --count samples are written. The lines of pages (--page_lines) are not generated again",
+        default=0,
+    )
+    parser.add_argument(
+        "-ps",
+        "--profile-stages",
+        type=str,
+        nargs="?",
+        help="Time every stage of the generation and print the total, median and 95th percentile of each at the end, or write them as JSON to the given file",
+        const="",
+        default=None,
+    )
+    parser.add_argument(
+        "-pm",
+        "--profile-memory",
+        type=str,
+        nargs="?",
+        help="Track the peak memory of every stage and sample type with tracemalloc and the RSS of every worker, then print them at the end, or write them as JSON to the given file (slows the generation down)",
+        const="",
+        default=None,
+    )
+    parser.add_argument(
+        "-cp",
+        "--cprofile",
+        type=str,
+        nargs="?",
+        help="Profile the generation in every worker with cProfile and write the profiles, a merged report (report.txt) and collapsed stacks for flame graphs (stacks.folded) to this directory",
+        default=None,
+    )
+    parser.add_argument(
+        "-tr",
+        "--trace",
+        type=str,
+        nargs="?",
+        help="Write the stages of every sample, on every worker, to this Chrome Trace Event file (open it in Perfetto)",
+        default=None,
+    )
+    parser.add_argument(
+        "-mx",
+        "--metrics",
+        type=str,
+        nargs="?",
+        help="Write the counts of samples written, samples rejected for a low contrast, font fallbacks and errors as JSON to this file",
+        default=None,
+    )
+    parser.add_argument(
+        "-sd",
+        "--seed",
+        type=int,
+        nargs="?",
+        help="Seed of the run, the same seed and arguments give the same samples. Drawn at random by default",
+        default=None,
+    )
+    parser.add_argument(
+        "-jn",
+        "--journal",
+        action="store_true",
+        help="Record the seed, the arguments and every finished sample in progress.jsonl in the output directory, as the samples are written, so that the run can be resumed with --resume",
+        default=False,
+    )
+    parser.add_argument(
+        "-re",
+        "--resume",
+        action="store_true",
+        help="Resume the run recorded in progress.jsonl in the output directory: only the samples it did not finish are generated, with the same seed and arguments",
+        default=False,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print a message for every rejected sample, font fallback and error",
+        default=False,
+    )
     return parser.parse_args()
 
 
@@ -352,12 +600,66 @@ def main():
     # Argument parsing
     args = parse_arguments()
 
+    # Samples are rendered at the largest height of the pyramid
+    if args.pyramid:
+        args.format = max(args.pyramid)
+
     # Create the directory if it does not exist.
     try:
         os.makedirs(args.output_dir)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+    for height in args.pyramid or []:
+        os.makedirs(os.path.join(args.output_dir, str(height)), exist_ok=True)
+
+    # With --journal, every finished task is appended to the journal as soon
+    # as its result arrives, a resumed run reads them back and only runs the
+    # others
+    journal_path = os.path.join(args.output_dir, JOURNAL)
+    done = {}
+    if args.resume:
+        if not os.path.isfile(journal_path):
+            sys.exit("No {} to resume from in {}".format(JOURNAL, args.output_dir))
+        if args.use_wikipedia:
+            sys.exit("Runs with Wikipedia text cannot be resumed")
+        header, done = read_journal(journal_path)
+        if args.seed is None:
+            args.seed = header["seed"]
+    elif args.seed is None:
+        args.seed = rnd.getrandbits(32)
+    # Through JSON, so that tuples compare equal to the lists read back
+    settings = json.loads(
+        json.dumps(
+            {k: v for k, v in vars(args).items() if k not in RESUME_IGNORED},
+            ensure_ascii=False,
+        )
+    )
+    if args.resume and settings != header["args"]:
+        sys.exit(
+            "The arguments differ from the run to resume: "
+            + ", ".join(
+                sorted(
+                    k
+                    for k in set(settings) | set(header["args"])
+                    if settings.get(k) != header["args"].get(k)
+                )
+            )
+        )
+    journal = None
+    if args.resume:
+        journal = open(journal_path, "a", encoding="utf8")
+    elif args.journal:
+        journal = open(journal_path, "w", encoding="utf8")
+        journal.write(
+            json.dumps({"seed": args.seed, "args": settings}, ensure_ascii=False)
+            + "\n"
+        )
+        journal.flush()
+
+    # The strings and the fonts are drawn from the seed of the run, and every
+    # task gets its own seed derived from it
+    rnd.seed(args.seed)
 
     # Creating word list
     if args.dict:
@@ -434,59 +736,256 @@ def main():
 
     string_count = len(strings)
 
-    p = Pool(args.thread_count)
-    for _ in tqdm(
-        p.imap_unordered(
-            FakeTextDataGenerator.generate_from_tuple,
+    annotations_file = None
+    if args.output_annotations:
+        annotations_file = open(
+            os.path.join(args.output_dir, "annotations.jsonl"),
+            "a" if args.resume else "w",
+            encoding="utf8",
+        )
+
+    line_labels_file = None
+    if args.line_crops:
+        line_labels_file = open(
+            os.path.join(args.output_dir, "line_labels.txt"),
+            "a" if args.resume else "w",
+            encoding="utf8",
+        )
+
+    p = (ThreadPool if args.backend == "threads" else Pool)(args.thread_count)
+
+    stage_timer = None
+    if (
+        args.profile_stages is not None
+        or args.trace
+        or args.profile_memory is not None
+    ):
+        stage_timer = StageTimer()
+    if args.cprofile:
+        os.makedirs(args.cprofile, exist_ok=True)
+        for path in os.listdir(args.cprofile):
+            if path.endswith(".prof"):
+                os.remove(os.path.join(args.cprofile, path))
+
+    counters = Counters()
+
+    def profiled(func):
+        # Every call then returns its index and the counts of its worker
+        # along with its result, runs under the profiler of its worker
+        # and/or returns its stage durations too
+        func = functools.partial(indexed_call, func)
+        func = functools.partial(counted_call, func, args.verbose)
+        if args.cprofile:
+            func = functools.partial(cprofiled_call, func, args.cprofile)
+        if stage_timer is not None:
+            func = functools.partial(
+                profiled_call,
+                func,
+                trace=bool(args.trace),
+                memory=args.profile_memory is not None,
+                describe=sample_type,
+            )
+        return func
+
+    start_time = time.perf_counter()
+
+    if args.page_lines > 0:
+        if args.orientation != 0 or args.handwritten:
+            sys.exit("Pages can only be composed with horizontal computer text")
+        if args.pyramid:
+            sys.exit("Pages cannot be composed with a resolution pyramid")
+        pages = range(0, string_count, args.page_lines)
+        total = len(pages)
+        # Fonts are drawn for every page, finished ones included, so that a
+        # resumed run gives the others the same fonts
+        page_fonts = [
+            [
+                fonts[rnd.randrange(0, len(fonts))]
+                for _ in strings[i : i + args.page_lines]
+            ]
+            for i in pages
+        ]
+        page_fonts = [f for i, f in zip(pages, page_fonts) if i not in done]
+        pages = [i for i in pages if i not in done]
+        results = p.imap_unordered(
+            profiled(FakeTextDataGenerator.generate_page_from_tuple),
             zip(
-                [i for i in range(0, string_count)],
-                strings,
-                [fonts[rnd.randrange(0, len(fonts))] for _ in range(0, string_count)],
-                [args.output_dir] * string_count,
-                [args.format] * string_count,
-                [args.extension] * string_count,
-                [args.skew_angle] * string_count,
-                [args.random_skew] * string_count,
-                [args.blur] * string_count,
-                [args.random_blur] * string_count,
-                [args.background] * string_count,
-                [args.distorsion] * string_count,
-                [args.distorsion_orientation] * string_count,
-                [args.handwritten] * string_count,
-                [args.name_format] * string_count,
-                [args.width] * string_count,
-                [args.alignment] * string_count,
-                [args.text_color] * string_count,
-                [args.orientation] * string_count,
-                [args.space_width] * string_count,
-                [args.character_spacing] * string_count,
-                [args.margins] * string_count,
-                [args.fit] * string_count,
-                [args.output_mask] * string_count,
-                [args.word_split] * string_count,
-                [args.image_dir] * string_count,
-                [args.stroke_width] * string_count,
-                [args.stroke_fill] * string_count,
-                [args.image_mode] * string_count,
-                [args.output_bboxes] * string_count,
+                pages,
+                [strings[i : i + args.page_lines] for i in pages],
+                page_fonts,
+                [args.output_dir] * len(pages),
+                [args.format] * len(pages),
+                [args.extension] * len(pages),
+                [args.skew_angle] * len(pages),
+                [args.random_skew] * len(pages),
+                [args.blur] * len(pages),
+                [args.random_blur] * len(pages),
+                [args.background] * len(pages),
+                [args.distorsion] * len(pages),
+                [args.distorsion_orientation] * len(pages),
+                [args.name_format] * len(pages),
+                [args.page_width] * len(pages),
+                [args.text_color] * len(pages),
+                [args.space_width] * len(pages),
+                [args.character_spacing] * len(pages),
+                [args.margins] * len(pages),
+                [args.fit] * len(pages),
+                [args.word_split] * len(pages),
+                [args.image_dir] * len(pages),
+                [args.stroke_width] * len(pages),
+                [args.stroke_fill] * len(pages),
+                [args.image_mode] * len(pages),
+                [args.blured_data_percentage] * len(pages),
+                [args.fused_geometry] * len(pages),
+                [args.direct_render] * len(pages),
+                [task_seed(args.seed, i) for i in pages],
             ),
-        ),
-        total=args.count,
-    ):
-        pass
-    p.terminate()
+        )
+    else:
+        # Only one string out of variants_per_render is rendered, its variants
+        # take the following indexes
+        renders = range(0, string_count, args.variants_per_render)
+        total = len(renders)
+        render_fonts = [fonts[rnd.randrange(0, len(fonts))] for _ in renders]
+        render_fonts = [f for i, f in zip(renders, render_fonts) if i not in done]
+        renders = [i for i in renders if i not in done]
+        results = p.imap_unordered(
+            profiled(FakeTextDataGenerator.generate_from_tuple),
+            zip(
+                renders,
+                [strings[i] for i in renders],
+                render_fonts,
+                [args.output_dir] * len(renders),
+                [args.format] * len(renders),
+                [args.extension] * len(renders),
+                [args.skew_angle] * len(renders),
+                [args.random_skew] * len(renders),
+                [args.blur] * len(renders),
+                [args.random_blur] * len(renders),
+                [args.background] * len(renders),
+                [args.distorsion] * len(renders),
+                [args.distorsion_orientation] * len(renders),
+                [args.handwritten] * len(renders),
+                [args.name_format] * len(renders),
+                [args.width] * len(renders),
+                [args.alignment] * len(renders),
+                [args.text_color] * len(renders),
+                [args.orientation] * len(renders),
+                [args.space_width] * len(renders),
+                [args.character_spacing] * len(renders),
+                [args.margins] * len(renders),
+                [args.fit] * len(renders),
+                [args.output_mask] * len(renders),
+                [args.word_split] * len(renders),
+                [args.image_dir] * len(renders),
+                [args.stroke_width] * len(renders),
+                [args.stroke_fill] * len(renders),
+                [args.image_mode] * len(renders),
+                [args.output_bboxes] * len(renders),
+                [args.blured_data_percentage] * len(renders),
+                [args.fused_geometry] * len(renders),
+                [args.direct_render] * len(renders),
+                [args.analytic_bboxes] * len(renders),
+                [args.output_annotations] * len(renders),
+                [args.line_crops] * len(renders),
+                [min(args.variants_per_render, string_count - i) for i in renders],
+                [args.pyramid] * len(renders),
+                [task_seed(args.seed, i) for i in renders],
+                [args.max_resamples] * len(renders),
+            ),
+        )
+
+    def label(i: int) -> str:
+        text = strings[i if args.page_lines > 0 else i - i % args.variants_per_render]
+        return text.replace(" ", "") if args.space_width == 0 else text
+
+    # File name and label of the samples actually written, by index,
+    # rejected ones are missing
+    written = {}
+    for samples in done.values():
+        for i, name, sample_label in samples:
+            written[i] = (name, sample_label)
+    progress = tqdm(results, total=total, initial=len(done))
+    for result in progress:
+        if stage_timer is not None:
+            result, recorded = result
+            stage_timer.merge(recorded)
+        result, counts = result
+        index, result = result
+        if counts:
+            counters.merge(counts)
+            progress.set_postfix(counters.summary(), refresh=False)
+        # Pages and multiple variants give one metadata per sample
+        samples = []
+        for meta_data in result if isinstance(result, list) else [result]:
+            if meta_data:
+                samples.append(
+                    (meta_data["index"], meta_data["name"], label(meta_data["index"]))
+                )
+                written[meta_data["index"]] = samples[-1][1:]
+            if (
+                annotations_file is not None
+                and meta_data
+                and "annotations" in meta_data
+            ):
+                annotations_file.write(
+                    json.dumps(meta_data["annotations"], ensure_ascii=False) + "\n"
+                )
+            if line_labels_file is not None and meta_data and "line_crops" in meta_data:
+                for file_name, line_label in meta_data["line_crops"]:
+                    line_labels_file.write("{} {}\n".format(file_name, line_label))
+        if journal is not None:
+            journal.write(
+                json.dumps({"index": index, "samples": samples}, ensure_ascii=False)
+                + "\n"
+            )
+            journal.flush()
+    if args.cprofile:
+        # Workers write their profiles when they exit normally
+        p.close()
+        p.join()
+        if args.backend == "threads":
+            dump_profiles(args.cprofile)
+        print("Profile written to " + write_profile_report(args.cprofile))
+    else:
+        p.terminate()
+
+    if args.profile_stages:
+        with open(args.profile_stages, "w") as f:
+            json.dump(stage_timer.summary(), f, indent=2)
+    elif args.profile_stages is not None:
+        print(stage_timer.report())
+    if args.trace:
+        stage_timer.write_trace(args.trace, start_time)
+    if args.profile_memory:
+        with open(args.profile_memory, "w") as f:
+            json.dump(stage_timer.memory_summary(), f, indent=2)
+    elif args.profile_memory is not None:
+        print(stage_timer.memory_report())
+
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            json.dump(counters.summary(), f, indent=2)
+
+    if journal is not None:
+        journal.close()
+    if annotations_file is not None:
+        annotations_file.close()
+    if line_labels_file is not None:
+        line_labels_file.close()
 
     if args.name_format == 2:
-        # Create file with filename-to-label connections
-        with open(
-            os.path.join(args.output_dir, "labels.txt"), "w", encoding="utf8"
-        ) as f:
-            for i in range(string_count):
-                file_name = str(i) + "." + args.extension
-                label = strings[i]
-                if args.space_width == 0:
-                    label = label.replace(" ", "")
-                f.write("{} {}\n".format(file_name, label))
+        # Create file with filename-to-label connections, in every output tree
+        for labels_dir in (
+            [os.path.join(args.output_dir, str(height)) for height in args.pyramid]
+            if args.pyramid
+            else [args.output_dir]
+        ):
+            with open(
+                os.path.join(labels_dir, "labels.txt"), "w", encoding="utf8"
+            ) as f:
+                for i in sorted(written):
+                    f.write("{} {}\n".format(*written[i]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,306 @@
+"""
+Serve samples to local clients over a Unix domain socket, from one shared
+pool of worker processes.
+
+Every message is a frame: a 4 bytes big-endian length, then the payload. A
+client sends one JSON frame with its configuration, for instance
+{"generator": "dict", "count": 1000, "size": 48}, where "generator" is
+"strings", "dict" or "random" and the other keys are arguments of that
+generator. The server then sends one frame per sample: a 4 bytes header
+length, a JSON header ({"label", "bboxes"}) and the encoded image. An empty
+frame ends the stream, a header with an "error" key reports a failure.
+
+Clients can only read fonts, dictionaries and background images from the
+bundled directories and from the paths the server is started with (-a).
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+from PIL import Image
+
+from trdg.data_generator import FakeTextDataGenerator
+from trdg.generators import GeneratorFromDict, GeneratorFromRandom, GeneratorFromStrings
+from trdg.generators.from_strings import _seed_worker
+
+GENERATORS = {
+    "strings": GeneratorFromStrings,
+    "dict": GeneratorFromDict,
+    "random": GeneratorFromRandom,
+}
+
+# Directories of the bundled fonts, dictionaries and background images
+BUNDLED_PATHS = [
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), directory)
+    for directory in ("fonts", "dicts", "images")
+]
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return struct.pack(">I", len(payload)) + payload
+
+
+def encode_sample(header: dict, image: bytes) -> bytes:
+    header = json.dumps(header, ensure_ascii=False).encode("utf8")
+    return encode_frame(struct.pack(">I", len(header)) + header + image)
+
+
+def decode_sample(payload: bytes) -> Tuple:
+    (header_length,) = struct.unpack(">I", payload[:4])
+    header = json.loads(payload[4 : 4 + header_length].decode("utf8"))
+    return header, payload[4 + header_length :]
+
+
+def render_samples(args: Tuple, kwargs: dict, image_format: str) -> list:
+    """
+    Run FakeTextDataGenerator.generate in a worker and encode its images,
+    so that only bytes go back to the server process
+    """
+
+    results = FakeTextDataGenerator.generate(*args, **kwargs)
+    if not isinstance(results, list):
+        results = [results]
+
+    samples = []
+    for result in results:
+        if result is None:
+            continue
+        image, meta_data = result
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+        samples.append((buffer.getvalue(), meta_data.get("bboxes")))
+    return samples
+
+
+class SampleServer(object):
+    def __init__(
+        self,
+        socket_path: str,
+        num_workers: int,
+        prefetch: int,
+        allowed_paths: List[str] = [],
+    ):
+        self.socket_path = socket_path
+        self.prefetch = prefetch
+        self.allowed_paths = [
+            os.path.realpath(path) for path in BUNDLED_PATHS + list(allowed_paths)
+        ]
+        self.executor = ProcessPoolExecutor(num_workers, initializer=_seed_worker)
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        futures = []
+        try:
+            config = json.loads(await self.read_frame(reader))
+            image_format = config.pop("format", "PNG")
+            # Loading the dictionary and the fonts would block the other clients
+            wrapper = await asyncio.get_running_loop().run_in_executor(
+                None, self.build_generator, config
+            )
+        except Exception as err:
+            writer.write(encode_sample({"error": repr(err)}, b""))
+            await writer.drain()
+            writer.close()
+            return
+
+        # The wrappers only refresh their strings, renders are made here
+        generator = getattr(wrapper, "generator", wrapper)
+        loop = asyncio.get_running_loop()
+        renders = -(-generator.count // generator.variants_per_render)
+        sent = 0
+        try:
+            while generator.count == -1 or sent < generator.count:
+                # Submit more renders only once the client took the previous
+                # samples (drain waits for it), this is the back-pressure
+                while len(futures) < self.prefetch and (
+                    generator.count == -1 or generator.render_count < renders
+                ):
+                    if hasattr(wrapper, "update_strings"):
+                        wrapper.update_strings()
+                    args, kwargs, label = generator.render_task(generator.render_count)
+                    generator.render_count += 1
+                    generator.generated_count += generator.variants_per_render
+                    futures.append(
+                        (
+                            loop.run_in_executor(
+                                self.executor,
+                                render_samples,
+                                args,
+                                kwargs,
+                                image_format,
+                            ),
+                            label,
+                        )
+                    )
+                if len(futures) == 0:
+                    break
+
+                future, label = futures.pop(0)
+                try:
+                    samples = await future
+                except Exception as err:
+                    # A failed render ends the stream like a bad configuration
+                    writer.write(encode_sample({"error": repr(err)}, b""))
+                    await writer.drain()
+                    return
+                for image, bboxes in samples:
+                    if generator.count != -1 and sent == generator.count:
+                        break
+                    writer.write(encode_sample({"label": label, "bboxes": bboxes}, image))
+                    sent += 1
+                await writer.drain()
+            writer.write(encode_frame(b""))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for future, _ in futures:
+                future.cancel()
+            writer.close()
+
+    def build_generator(self, config: dict):
+        generator = GENERATORS[config.pop("generator", "dict")]
+        paths = list(config.get("fonts", [])) + [
+            config[key] for key in ("path", "image_dir") if config.get(key)
+        ]
+        if generator is GeneratorFromDict and not config.get("path"):
+            paths.append(
+                os.path.join(
+                    os.path.dirname(os.path.realpath(__file__)),
+                    "dicts",
+                    config.get("language", "en") + ".txt",
+                )
+            )
+        for path in paths:
+            self.check_path(path)
+        return generator(**config)
+
+    def check_path(self, path: str):
+        """
+        Raise if a path sent by a client is outside of the allowed directories
+        """
+
+        path = os.path.realpath(path)
+        if not any(
+            os.path.commonpath([path, allowed]) == allowed
+            for allowed in self.allowed_paths
+        ):
+            raise PermissionError("{} is not in an allowed directory".format(path))
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    async def read_frame(reader) -> bytes:
+        (length,) = struct.unpack(">I", await reader.readexactly(4))
+        return await reader.readexactly(length)
+
+
+class SampleClient(object):
+    """
+    Iterate over the samples of a server like over a generator: every item
+    is ((image, {"bboxes": ...}), label). The keyword arguments are the
+    configuration sent to the server.
+    """
+
+    def __init__(self, socket_path: str, **config):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.socket.sendall(
+            encode_frame(json.dumps(config, ensure_ascii=False).encode("utf8"))
+        )
+        self.stream = self.socket.makefile("rb")
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        (length,) = struct.unpack(">I", self.read(4))
+        if length == 0:
+            self.close()
+            raise StopIteration
+
+        header, image = decode_sample(self.read(length))
+        if "error" in header:
+            self.close()
+            raise RuntimeError(header["error"])
+        return (Image.open(io.BytesIO(image)), {"bboxes": header["bboxes"]}), header[
+            "label"
+        ]
+
+    def read(self, length: int) -> bytes:
+        data = self.stream.read(length)
+        if len(data) < length:
+            self.close()
+            raise ConnectionError("The server closed the connection")
+        return data
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+def main():
+    """
+    Description: Start a sample server
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Serve generated samples to local clients over a Unix socket"
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        type=str,
+        help="Path of the Unix domain socket",
+        default="/tmp/trdg.sock",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes shared by all the clients",
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "-p",
+        "--prefetch",
+        type=int,
+        help="Number of renders in flight for each client",
+        default=4,
+    )
+    parser.add_argument(
+        "-a",
+        "--allow",
+        type=str,
+        nargs="+",
+        help="Directories or files the clients can read fonts, dictionaries and images from, besides the bundled ones",
+        default=[],
+    )
+    args = parser.parse_args()
+
+    server = SampleServer(args.socket, args.workers, args.prefetch, args.allow)
+    try:
+        asyncio.run(server.serve())
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
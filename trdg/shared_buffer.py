@@ -0,0 +1,97 @@
+"""
+Fixed-size slots in shared memory, so that worker processes can hand images
+back to the parent without pickling their pixels
+"""
+
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Tuple
+
+import numpy as np
+
+from trdg.data_generator import FakeTextDataGenerator
+
+# Buffers this process is attached to, by name (workers attach once)
+_attached = {}
+
+
+class SharedRingBuffer(object):
+    """
+    slot_count slots of slot_size bytes in one shared memory block. Slots
+    are handed out and given back by the process that created the buffer.
+    """
+
+    def __init__(self, slot_count: int, slot_size: int):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=slot_count * slot_size
+        )
+        self.free = deque(range(slot_count))
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def acquire(self) -> int:
+        """
+        Take the oldest free slot
+        """
+
+        return self.free.popleft()
+
+    def release(self, slot: int):
+        """
+        Give a slot back once its content is not used anymore
+        """
+
+        self.free.append(slot)
+
+    def view(self, slot: int, shape: Tuple) -> np.ndarray:
+        """
+        uint8 array of the given shape over the content of a slot, without
+        copying it. It is only valid until the slot is released.
+        """
+
+        return np.ndarray(
+            shape, dtype=np.uint8, buffer=self.memory.buf, offset=slot * self.slot_size
+        )
+
+    def close(self):
+        self.memory.unlink()
+        try:
+            self.memory.close()
+        except BufferError:
+            # Views are still alive, the memory is freed along with them
+            pass
+
+
+def generate_into_slot(
+    name: str, slot_size: int, slot: int, args: Tuple, kwargs: dict
+) -> Tuple:
+    """
+    Run FakeTextDataGenerator.generate (in a worker process) and write the
+    image into a slot of the shared buffer called name. Returns the shape of
+    the image and the metadata, or (None, None) if no image was generated.
+    """
+
+    result = FakeTextDataGenerator.generate(*args, **kwargs)
+    if result is None:
+        return None, None
+
+    image, meta_data = result
+    array = np.asarray(image)
+    if array.nbytes > slot_size:
+        raise ValueError(
+            "A {} image does not fit in a slot of {} bytes".format(
+                "x".join([str(v) for v in array.shape]), slot_size
+            )
+        )
+
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    np.ndarray(
+        array.shape, dtype=np.uint8, buffer=_attached[name].buf, offset=slot * slot_size
+    )[...] = array
+
+    return array.shape, meta_data
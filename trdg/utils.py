@@ -101,6 +101,49 @@ def mask_to_bboxes(mask: List[Tuple[int, int, int, int]], tess: bool = False):
     return bboxes
 
 
+def quads_to_bboxes(
+    quads: np.ndarray, size: Tuple[int, int], tess: bool = False
+) -> List[Tuple[int, int, int, int]]:
+    """Turn (N, 4, 2) quadrilaterals into AABB bounding boxes clipped to the image"""
+
+    width, height = size
+
+    x1 = np.clip(np.floor(quads[..., 0].min(axis=-1)), 0, width - 1).astype(int)
+    y1 = np.clip(np.floor(quads[..., 1].min(axis=-1)), 0, height - 1).astype(int)
+    x2 = np.clip(np.ceil(quads[..., 0].max(axis=-1)), 0, width - 1).astype(int)
+    y2 = np.clip(np.ceil(quads[..., 1].max(axis=-1)), 0, height - 1).astype(int)
+
+    if tess:
+        # Tesseract boxes have their origin at the bottom left of the image
+        y1, y2 = height - 1 - y2, height - 1 - y1
+
+    return [tuple(int(v) for v in bbox) for bbox in zip(x1, y1, x2, y2)]
+
+
+def layout_to_annotations(
+    lines: List[str],
+    line_quads: np.ndarray,
+    words: List[str],
+    word_quads: np.ndarray,
+    word_lines: List[int],
+    size: Tuple[int, int],
+) -> List[dict]:
+    """Group word and line quadrilaterals into JSON serializable line annotations"""
+
+    def annotation(text, quad):
+        return {
+            "text": text,
+            "bbox": quads_to_bboxes(quad[None], size)[0],
+            "quad": [int(v) for v in np.rint(quad).flatten()],
+        }
+
+    annotations = [dict(annotation(l, q), words=[]) for l, q in zip(lines, line_quads)]
+    for word, quad, line in zip(words, word_quads, word_lines):
+        annotations[line]["words"].append(annotation(word, quad))
+
+    return annotations
+
+
 def draw_bounding_boxes(
     img: Image, bboxes: List[Tuple[int, int, int, int]], color: str = "green"
 ) -> None: